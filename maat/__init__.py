@@ -29,20 +29,29 @@ import sys
 
 from maat import action
 from maat import build
+from maat import cache
 from maat import common
 from maat import config
+from maat import db
+from maat import digest
 from maat import env
+from maat import graph
 from maat import io
+from maat import jobserver
 from maat import lowlevel
 from maat import recipe
+from maat import server
 from maat import services
 from maat import sign
+from maat import throttle
+from maat import watch
 
 
 # global variables
 version = "0.5"
 topdir = env.topdir	# top directory
 todo = []			# goals to do
+defs = []			# definitions of the command line
 verbose = False		# verbose mode
 do_config = False	# configuration need to be done
 do_list = False		# list the goals
@@ -91,6 +100,27 @@ def panic(msg):
 set_env(env.cur)
 
 
+def jobs_arg(text):
+	"""Parse the argument of -j option."""
+	if text == "auto":
+		return text
+	else:
+		return int(text)
+
+
+def jobs_args(args):
+	"""As with GNU make, -j (or --jobs) followed by something else than
+	a number or auto (like a goal) is considered as given without N."""
+	r = []
+	for i in range(len(args)):
+		if args[i] in ("-j", "--jobs") and i + 1 < len(args) \
+		and args[i + 1] != "auto" and not args[i + 1].isdigit() and not args[i + 1].startswith("-"):
+			r.append("--jobs=%d" % os.cpu_count())
+		else:
+			r.append(args[i])
+	return r
+
+
 # parse arguments
 if not inspect.stack()[-1][1].endswith("pydoc"):
 
@@ -104,12 +134,27 @@ if not inspect.stack()[-1][1].endswith("pydoc"):
 	parser.add_argument('-n', '--dry-run', '--just-print',  action="store_true", default=False, help="display the commands but does not execute them")
 	parser.add_argument('-t', '--time', action="store_true", default=False, help="display processing time")
 	parser.add_argument('-s', '--quiet', '--silent', action="store_true", default=False, help="work in quiet mode (doesn't display anything)")
+	parser.add_argument('-k', '--keep-going', action="store_true", default=False, help="build as many targets as possible after a failure")
 	parser.add_argument('-B', '--always-make', action="store_true", default=False, help="rebuild all without checking for updates")
 	parser.add_argument('-q', '--question', action="store_true", default=False, help="test if something has to be updated (result in return code)")
+	parser.add_argument('-j', '--jobs', type=jobs_arg, nargs='?', const=os.cpu_count(), default=None, metavar="N", help="run up to N jobs in parallel (as many as processors if N is omitted or if run by make with a jobserver, from processors and memory used at the previous builds if N is auto)")
+	parser.add_argument('-L', '--max-load', type=float, default=None, metavar="LOAD", help="do not start new jobs while the load average is at least LOAD")
+	parser.add_argument('--min-memory', type=common.parse_size, default=None, metavar="SIZE", help="do not start new jobs while the available memory is lower than SIZE")
+	parser.add_argument('--scan', action="store_true", default=False, help="get the status of all files of the project at once before building")
+	parser.add_argument('--stat-jobs', type=int, default=0, metavar="N", help="get the status of files with N threads before building (useful on network file systems)")
+	parser.add_argument('--content', action="store_true", default=False, help="rebuild targets only if the content of their dependencies changed")
+	parser.add_argument('--cache', type=str, nargs='?', const=cache.default_path(), default=None, metavar="DIR", help="get the results of the recipes from the cache in DIR (default %s) if possible" % cache.default_path())
+	parser.add_argument('--cache-size', type=common.parse_size, default=cache.limit, metavar="SIZE", help="maximum size of the cache (with unit K, M, G or T, default %s)" % common.format_size(cache.limit))
+	parser.add_argument('--remote-cache', type=str, default=None, metavar="URL", help="share the results of the recipes with the HTTP cache at URL (in addition to the local cache)")
+	parser.add_argument('--remote-cache-mode', type=str, choices=["ro", "rw"], default="ro", help="read-only (default) or read-write access to the remote cache")
+	parser.add_argument('--graph-cache', action="store_true", default=False, help="do not run the scripts if the build graph saved at the previous build shows that nothing has to be done")
+	parser.add_argument('--server', action="store_true", default=False, help="run a build server keeping the build graph in memory")
+	parser.add_argument('--client', action="store_true", default=False, help="ask the build server to perform the build")
+	parser.add_argument('-w', '--watch', action="store_true", default=False, help="build again the goals each time a file they depend on changes")
 	parser.add_argument('-e', '--embed', action="store_true", default=False, help="embed Maat in the current directory (making the project easier to compile)")
 
 	# get arguments
-	args = parser.parse_args()
+	args = parser.parse_args(jobs_args(sys.argv[1:]))
 	if args.version:
 		print(\
 """Maat V%s\nCopyright (c) 2016 H. Casse <hugues.casse@laposte.net>
@@ -123,11 +168,38 @@ warranty; not even for MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.""" %
 	do_time = args.time
 	do_quiet = args.quiet
 	do_always = args.always_make
+	do_keep_going = args.keep_going
 	do_embed = args.embed
+	do_jobs = args.jobs
+	if jobserver.connect():
+		if do_jobs == None:
+			do_jobs = jobserver.get_jobs()
+	elif do_jobs == None:
+		do_jobs = 1
+	throttle.max_load = args.max_load
+	throttle.min_memory = args.min_memory
+	do_scan = args.scan
+	do_stat_jobs = args.stat_jobs
+	do_content = args.content
+	do_graph_cache = args.graph_cache
+	cache.path = args.cache
+	cache.limit = args.cache_size
+	if args.remote_cache:
+		if cache.path == None:
+			cache.path = cache.default_path()
+		cache.remote = args.remote_cache.rstrip("/")
+		cache.writable = args.remote_cache_mode == "rw"
+	do_server = args.server
+	do_client = args.client
+	do_watch = args.watch
 	if args.dry_run:
 		builder = build.DryBuilder
+		db.read_only = True
 	elif args.question:
 		builder = build.QuestBuilder
+		db.read_only = True
+	elif do_jobs == "auto" or do_jobs > 1:
+		builder = build.ParBuilder
 	else:
 		builder = build.SeqBuilder
 
@@ -139,6 +211,7 @@ warranty; not even for MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.""" %
 			if a == "config":
 				do_config = True
 		else:
+			defs.append(a)
 			env.root.set(p[0], p[1])
 
 	# load configuration
@@ -165,12 +238,7 @@ def make_work(ctx = io.Context()):
 		return
 
 	# prepare context
-	ctx = io.Context()
-	if verbose:
-		ctx.command_ena = True
-	if do_quiet:
-		ctx.quiet = True
-		ctx.complete_quiet = True
+	ctx = make_context()
 
 	# post-initializations
 	for post in common.post_inits:
@@ -186,28 +254,43 @@ def make_work(ctx = io.Context()):
 	
 	# build action
 	else:
+		action.handle_signals()
 		
 		# command line services
 		if do_list:
 			services.list_goals(ctx)
 		elif do_print_db:
 			services.print_db()
+
+		# run the server
+		elif do_server:
+			try:
+				server.serve(ctx, defs, serve_build)
+			except common.MaatError as e:
+				ctx.print_error(e)
+				os._exit(1)
+			except KeyboardInterrupt as e:
+				os._exit(0)
+
+		# watch the files
+		elif do_watch:
+			try:
+				watch.run(ctx, defs, get_goals(), lambda: watch_build(ctx))
+			except common.MaatError as e:
+				ctx.print_error(e)
+				os._exit(1)
+			except KeyboardInterrupt as e:
+				os._exit(0)
 		
 		# do the build
 		else:
 			try:
-				global todo
-				if not todo:
-					todo = ["all"]
-				sign.load(ctx)
-				targets = []
-				for target in todo:
-					target = recipe.get_goal(target)
-					target.collect_updates(targets)
-				b = builder(ctx, targets, do_always)
-				if do_time:
-					b.show_time = True
-				b.build()
+				targets = collect_targets(ctx)
+				if do_graph_cache:
+					graph.remove()
+				build_targets(ctx, targets)
+				if do_graph_cache:
+					graph.save(defs)
 				os._exit(0)
 			except common.MaatError as e:
 				ctx.print_error(e)
@@ -217,6 +300,110 @@ def make_work(ctx = io.Context()):
 				os._exit(2)
 
 
+def make_context():
+	"""Build the context of the build from the command line."""
+	ctx = io.Context()
+	if verbose:
+		ctx.command_ena = True
+	if do_quiet:
+		ctx.quiet = True
+		ctx.complete_quiet = True
+	return ctx
+
+
+def get_goals():
+	"""Get the goals of the command line."""
+	global todo
+	if not todo:
+		todo = ["all"]
+	return [recipe.get_goal(target) for target in todo]
+
+
+def collect_targets(ctx):
+	"""Collect the targets to update to make the goals of the command
+	line (all the targets with -B)."""
+	sign.load(ctx)
+	if do_scan:
+		scan_tree()
+	goals = get_goals()
+	if do_stat_jobs > 0:
+		common.prefetch(recipe.actual_files(goals), do_stat_jobs)
+	digest.load(ctx)
+	if do_content:
+		digest.enabled = True
+		digest.prepare(recipe.actual_files(goals), os.cpu_count())
+	targets = []
+	for target in goals:
+		if do_always:
+			target.collect_all(targets)
+		else:
+			target.collect_updates(targets)
+	return targets
+
+
+def build_targets(ctx, targets):
+	"""Build the given targets."""
+	b = builder(ctx, targets, do_always)
+	b.jobs = get_jobs()
+	b.keep_going = do_keep_going
+	if do_time:
+		b.show_time = True
+	b.build()
+
+
+def serve_build(goals, out, err):
+	"""Perform a build for the server and return the exit code."""
+	global todo
+	todo = goals
+	ctx = make_context()
+	ctx.out = out
+	ctx.err = err
+	common.forget()
+	recipe.reset_updates()
+	try:
+		build_targets(ctx, collect_targets(ctx))
+		return 0
+	except common.MaatError as e:
+		ctx.print_error(e)
+		return 1
+	finally:
+		set_env(env.top)
+		env.top.path.set_cur()
+
+
+def get_jobs():
+	"""Get the number of jobs of the build. If needed, the jobserver is
+	created at the first call."""
+	global do_jobs
+	if do_jobs == "auto":
+		do_jobs = throttle.auto_jobs()
+	if do_jobs > 1 and jobserver.current == None:
+		jobserver.create(do_jobs)
+	return do_jobs
+
+
+def watch_build(ctx):
+	"""Perform a build in watch mode."""
+	try:
+		build_targets(ctx, collect_targets(ctx))
+	except common.MaatError as e:
+		ctx.print_error(e)
+	finally:
+		set_env(env.top)
+		env.top.path.set_cur()
+
+
+def scan_tree():
+	"""Record the status of the files of the top directory and of
+	the build directory."""
+	common.scan(env.top.path)
+	bpath = env.top["BPATH"]
+	if bpath:
+		bpath = (env.top.path / bpath).norm()
+		if not bpath.prefixed_by(env.top.path):
+			common.scan(bpath)
+
+
 old_except_hook = sys.excepthook
 def on_except(t, v, tb):
 	common.script_failed = True
@@ -281,6 +468,7 @@ def subdir(dir):
 	push_env(env.ScriptEnv(name, dpath, curenv, { }))
 	
 	# load make.py
+	graph.scripts.append(str(path))
 	mod = imp.load_source(name, str(path))
 	curenv.map = mod.__dict__
 	
@@ -290,6 +478,12 @@ def subdir(dir):
 
 
 
+def pool(name, size):
+	"""Define a resource pool: at most size jobs whose target has
+	the variable POOL set to name are run at the same time."""
+	build.pools[name] = size
+
+
 def concat(s1, s2):
 	"""Join two values, using the best type: list if one is a least,
 	string else.."""
@@ -480,3 +674,22 @@ def actions(*actions):
 def directory(name):
 	"""Build a rule building a directory."""
 	return rule(name, None, makedir(name))
+
+
+###### build from the server or from the graph cache #####
+
+if not inspect.stack()[-1][1].endswith("pydoc") and do_client:
+	os._exit(server.connect(todo, defs))
+
+if not inspect.stack()[-1][1].endswith("pydoc") \
+and do_graph_cache and not (do_always or do_list or do_print_db or do_config or do_embed or do_watch or do_server) \
+and graph.load(defs):
+	ctx = make_context()
+	try:
+		targets = collect_targets(ctx)
+		if not [t for t in targets if t.recipe != None and t.recipe.active]:
+			build_targets(ctx, targets)
+			os._exit(0)
+	except common.MaatError as e:
+		pass
+	graph.reset()
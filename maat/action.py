@@ -17,16 +17,19 @@
 """Represents the action that may be performed to build
 the recipes."""
 
+import concurrent.futures
 import os
 import re
-import select
 import shutil
+import signal
 import subprocess
-import sys
+import time
 
 from maat import common
+from maat import engine
 from maat import env
 from maat import io
+from maat import jobserver
 from maat import lowlevel
 from maat import recipe
 
@@ -44,8 +47,71 @@ def make_line(args):
 			line = line + " " + str(a)
 	return line
 
+KILL_DELAY = 2
+"""Time (in seconds) let to a command to stop after SIGTERM before
+being killed by SIGKILL."""
+running = { }
+"""Process groups of the running commands."""
+
+
+def signal_groups(groups, sig):
+	"""Send the given signal to the given process groups."""
+	for pgid in groups:
+		try:
+			os.killpg(pgid, sig)
+		except (ProcessLookupError, PermissionError):
+			pass
+
+
+def cancel():
+	"""Stop the running commands: SIGTERM is sent to their process
+	groups and, if they are still running after KILL_DELAY, SIGKILL.
+	The commands are waited by the threads that launched them."""
+	signal_groups(list(running), signal.SIGTERM)
+	end = time.time() + KILL_DELAY
+	while running and time.time() < end:
+		time.sleep(.05)
+	signal_groups(list(running), signal.SIGKILL)
+	end = time.time() + KILL_DELAY
+	while running and time.time() < end:
+		time.sleep(.05)
+
+
+def terminate(sig, frame):
+	"""Handler of SIGTERM and SIGHUP."""
+	raise KeyboardInterrupt()
+
+
+def handle_signals():
+	"""Stop the build on SIGTERM and SIGHUP as on an interruption by
+	the user. As the commands run in their own process groups, they
+	do not receive the signals sent to the process group of Maat
+	and have to be stopped by Maat itself. The signals that are ignored
+	(like SIGHUP with nohup) stay ignored."""
+	for sig in (signal.SIGTERM, signal.SIGHUP):
+		if signal.getsignal(sig) != signal.SIG_IGN:
+			signal.signal(sig, terminate)
+
+
+def stop(proc, future):
+	"""Stop the given process (and its process group) and wait for
+	the end of its supervision."""
+	signal_groups([proc.pid], signal.SIGTERM)
+	try:
+		future.result(KILL_DELAY)
+	except concurrent.futures.TimeoutError:
+		signal_groups([proc.pid], signal.SIGKILL)
+		future.result()
+
+
 def invoke(cmd, ctx, out = None, err = None):
-	"""Launch the given command in the current shell."""
+	"""Launch the given command in the current shell. The command is run
+	in its own process group to be stopped with its sub-processes
+	if the build is interrupted. As the process group is not the one
+	of the terminal, a command reading the terminal is stopped by SIGTTIN:
+	interactive commands have to be avoided. Its outputs and its end are
+	supervised by the engine while the calling thread waits with the global
+	lock released."""
 	if  cmd == "None":
 		cmd()
 
@@ -54,7 +120,6 @@ def invoke(cmd, ctx, out = None, err = None):
 	ctx.print_command(line)
 	
 	# prepare streams
-	ins = []
 	if out == False:
 		out_arg = subprocess.DEVNULL
 	elif out == None:
@@ -69,26 +134,28 @@ def invoke(cmd, ctx, out = None, err = None):
 		err_arg = err
 
 	# run the process
-	proc = subprocess.Popen(line, shell=True, stdout = out_arg, stderr = err_arg)
+	proc = subprocess.Popen(line, shell=True, stdout = out_arg, stderr = err_arg, pass_fds = jobserver.fds(), preexec_fn = os.setpgrp)
+	running[proc.pid] = True
 	
-	# manage outputs
-	map = { }
+	# supervise the process
+	streams = []
 	if out == None:
-		map[proc.stdout] = ctx.out
+		streams.append((proc.stdout, ctx.out))
 	if err == None:
-		map[proc.stderr] = ctx.err
-	ins = list(map.keys())
-	while ins:
-		useds, x, y = select.select(ins, [], [])
-		for used in useds:
-			line = used.readline()
-			if line:
-				map[used].write(line.decode(sys.getdefaultencoding()))
-			else:
-				ins.remove(used)
-	
-	# wait end of called process
-	r = proc.wait()
+		streams.append((proc.stderr, ctx.err))
+	state = common.lock.suspend()
+	try:
+		future = engine.run(proc, streams)
+		try:
+			r, memory = future.result()
+		except KeyboardInterrupt as e:
+			stop(proc, future)
+			raise e
+		proc.returncode = r
+		ctx.memory = max(ctx.memory, memory)
+	finally:
+		running.pop(proc.pid, None)
+		common.lock.resume(state)
 	if r != 0:
 		common.error("build failed")
 
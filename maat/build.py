@@ -19,19 +19,44 @@ that can only be done once their dependencies has been built.
 Several build methods exist: DryBuilder, QuestBuilder, SeqBuilder
 and ParBuilder."""
 
+import copy
+import heapq
 import os
+import queue
 import sys
+import threading
 
 import maat
+from maat import action
+from maat import cache
 from maat import common
+from maat import db
+from maat import digest
 from maat import io
+from maat import jobserver
+from maat import recipe
 from maat import sign
+from maat import throttle
+
+pools = { }
+"""Capacities of the resource pools (map of pool name and maximum
+number of jobs of the pool running at the same time)."""
+
 
 class Job:
 	
 	def __init__(self, builder, target):
 		self.builder = builder
 		self.target = target
+		self.ctx = builder.ctx
+		self.count = 0
+		self.succs = []
+		self.waits = False
+		self.updated = False
+		self.fingerprint = None
+		self.unchanged = False
+		self.priority = 0
+		self.in_pool = False
 		self.start_time = 0
 		self.end_time = 0
 	
@@ -49,9 +74,37 @@ class Job:
 		if self.target.recipe:
 			maat.pop_env()
 
+	def pool(self):
+		"""Get the resource pool of the job (given by the POOL variable
+		of the target) or None."""
+		p = self.target.POOL
+		if p == None or p not in pools:
+			return None
+		else:
+			return p
+
+	def results(self):
+		"""Get the non-phony files produced by the job."""
+		if self.target.recipe == None:
+			return []
+		else:
+			return [r for r in self.target.recipe.ress if not r.is_phony]
+
+	def get_fingerprint(self):
+		"""Get the fingerprint of the content of the results of the job.
+		Return None if one of the results doesn't exist."""
+		f = [digest.get(r.actual()) for r in self.results()]
+		if not f or None in f:
+			return None
+		else:
+			return f
+
 	def prepare(self):
 		"""Prepare the target to run the action."""
 		self.start_time = common.time()
+		self.ctx.memory = 0
+		if self.target.RESTAT:
+			self.fingerprint = self.get_fingerprint()
 		if self.target.recipe != None:
 			for r in self.target.recipe.ress:
 				ppath = r.actual().parent()
@@ -66,53 +119,214 @@ class Job:
 		"""Finalzie the target after the action execution."""
 		self.pop_env()
 		sign.record(self.target)
+		digest.record(self.target)
+		recipe.fold_deps(self.target)
+		if self.target.recipe:
+			for r in self.target.recipe.ress:
+				r.invalidate()
+		if self.fingerprint != None and self.fingerprint == self.get_fingerprint():
+			self.set_unchanged()
 		self.end_time = common.time()
+		db.execute("INSERT OR REPLACE INTO durations VALUES (?, ?)", (str(self.target), self.duration()))
+		if self.ctx.memory:
+			db.execute("INSERT OR REPLACE INTO memory VALUES (?, ?)", (str(self.target), self.ctx.memory))
+		db.commit(self.ctx)
+
+	def set_unchanged(self):
+		"""Record that the results of the job did not change."""
+		self.unchanged = True
+		for r in self.results():
+			recipe.unchanged.add(r)
+
+	def can_skip(self):
+		"""Test if the job can be skipped because all the jobs it was
+		waiting for produced unchanged results (never when all is
+		rebuilt)."""
+		if self.builder.force or not self.waits or self.updated:
+			return False
+		self.target.invalidate()
+		return not self.target.check_update()
+
+	def skip(self):
+		"""Skip the job: its results are only touched to be newer
+		than their dependencies."""
+		for r in self.results():
+			try:
+				os.utime(str(r.actual()))
+			except OSError as e:
+				common.error(str(e))
+			r.invalidate()
+		self.set_unchanged()
 
 	def build(self):
 		"""Build the given target."""
 		self.prepare()
-		if self.target.recipe:
-			self.target.recipe.action(self.builder.ctx)
+		try:
+			if self.target.recipe:
+				self.run()
+		except Exception as e:
+			self.pop_env()
+			raise e
 		self.finalize()
 
+	def run(self):
+		"""Run the action of the recipe or, if possible, get its
+		results from the cache."""
+		key = cache.key(self.target)
+		if key == None:
+			self.target.recipe.action(self.ctx)
+		elif not cache.fetch(key, self.target, self.ctx):
+			cache.detach(self.target)
+			out, err = self.ctx.out, self.ctx.err
+			self.ctx.out, self.ctx.err = cache.Recorder(out), cache.Recorder(err)
+			try:
+				self.target.recipe.action(self.ctx)
+				cache.store(key, self.target, self.ctx, self.ctx.out.text, self.ctx.err.text)
+			finally:
+				self.ctx.out, self.ctx.err = out, err
+
 	def __str__(self):
 		return str(self.target)
 
 
 class Builder:
 	"""Provide a way to build the targets."""
+	runs = False
+	"""True if the builder runs the jobs (ordered by priority)."""
 
 	def __init__(self, ctx, targets, force = False):
 		self.ctx = ctx
 		self.todo = [Job(self, t) for t in targets]
 		self.done = []
-		self.current = []
+		self.current = set()
 		self.total = len(targets)
 		self.show_time = False
+		self.jobs = 1
 		self.start_time = common.time()
 		self.force = force
-	
+		self.keep_going = False
+		self.failed = []
+
+		# build the job graph: count of pending dependencies and successors
+		map = { }
+		for job in self.todo:
+			map[job.target] = job
+		for job in self.todo:
+			if job.target.recipe != None:
+				for d in set(job.target.recipe.deps):
+					if d in map and d != job.target:
+						job.count = job.count + 1
+						job.waits = True
+						map[d].succs.append(job)
+		if self.runs:
+			self.compute_priorities()
+		self.ready = []
+		self.pushed = 0
+		self.used = dict([(p, 0) for p in pools])
+		for job in self.todo:
+			if job.count == 0:
+				self.push(job)
+
+	def compute_priorities(self):
+		"""Compute the priority of the jobs: the longest duration of the
+		paths from the job to the goals using the durations recorded at
+		the previous builds (the mean duration for unknown jobs)."""
+		db.open(self.ctx)
+		durations = { }
+		for target, duration in db.query_all("SELECT target, duration FROM durations"):
+			durations[target] = duration
+		if durations:
+			mean = sum(durations.values()) / len(durations)
+		else:
+			mean = 1
+		counts = dict([(job, job.count) for job in self.todo])
+		order = [job for job in self.todo if job.count == 0]
+		for job in order:
+			for succ in job.succs:
+				counts[succ] = counts[succ] - 1
+				if counts[succ] == 0:
+					order.append(succ)
+		for job in reversed(order):
+			job.priority = durations.get(str(job.target), mean) \
+				+ max([succ.priority for succ in job.succs] + [0])
+
+	def push(self, job):
+		"""Add a job to the ready jobs."""
+		heapq.heappush(self.ready, (-job.priority, self.pushed, job))
+		self.pushed = self.pushed + 1
+
 	def start(self, job):
 		"""Mark the given job."""
-		self.current.append(job)
-	
+		self.current.add(job)
+
 	def next(self):
-		"""Return next job to do or None."""
-		for j in self.todo:
-			if  j not in self.current \
-			and (self.force or j.target.recipe == None or all(d not in self.todo for d in j.target.recipe.deps)):
-				self.start(j)
-				return j
-		return None
+		"""Return next job to do or None. Jobs that only depend
+		on unchanged results are skipped and jobs whose resource pool
+		is full are kept for later."""
+		blocked = []
+		try:
+			while self.ready:
+				item = heapq.heappop(self.ready)
+				job = item[2]
+				pool = job.pool()
+				if pool != None and self.used[pool] >= pools[pool]:
+					blocked.append(item)
+					continue
+				self.start(job)
+				if not job.can_skip():
+					if pool != None:
+						self.used[pool] = self.used[pool] + 1
+						job.in_pool = True
+					return job
+				job.skip()
+				self.complete(job)
+			return None
+		finally:
+			for item in blocked:
+				heapq.heappush(self.ready, item)
 	
+	def release(self, job):
+		"""Release the resource pool used by the job."""
+		if job.in_pool:
+			self.used[job.pool()] = self.used[job.pool()] - 1
+			job.in_pool = False
+
 	def complete(self, job):
 		"""Mark the target t as completed."""
-		self.todo.remove(job)
+		self.release(job)
 		self.current.remove(job)
 		self.done.append(job)
-		if not self.todo:
+		for succ in job.succs:
+			if not job.unchanged:
+				succ.updated = True
+			succ.count = succ.count - 1
+			if succ.count == 0:
+				self.push(succ)
+		if len(self.done) == self.total:
 			self.total_time = common.time() - self.start_time
 
+	def fail(self, job, error):
+		"""Record the failure of a job in keep-going mode: the jobs
+		depending on it will never be ready."""
+		self.release(job)
+		self.current.remove(job)
+		self.failed.append((job, error))
+		self.ctx.print_error("%s: %s" % (job, error))
+
+	def check_failures(self):
+		"""At the end of a keep-going build, display the failed jobs
+		and raise a MaatError if there is one."""
+		if not self.failed:
+			return
+		self.ctx.print_error("%d target(s) failed:" % len(self.failed))
+		for job, error in self.failed:
+			self.ctx.print_error("  %s: %s" % (job, error))
+		missed = self.total - len(self.done) - len(self.failed)
+		if missed:
+			common.error("%d target(s) not built because of the failures" % missed)
+		else:
+			common.error("build failed")
+
 	def progress(self):
 		"""Return the program in percent."""
 		return len(self.done) * 100 / self.total
@@ -156,6 +370,7 @@ class QuestBuilder(Builder):
 
 class SeqBuilder(Builder):
 	"""Builder that performs the drive sequentially."""
+	runs = True
 
 	def __init__(self, ctx, targets, force):
 		Builder.__init__(self, ctx, targets, force)
@@ -166,7 +381,6 @@ class SeqBuilder(Builder):
 				self.ctx.print_action(io.BLUE + io.BOLD + ("[%3d%%] Making %s" % (self.progress(), job.target)) + io.NORMAL)
 			else:
 				self.ctx.print_info("[%3d%%] Making %s" % (self.progress(), job.target))
-		self.start(job)
 		job.build()
 		self.complete(job)
 		if not job.target.is_hidden and self.show_time:
@@ -176,17 +390,199 @@ class SeqBuilder(Builder):
 		try:
 			job = self.next()
 			while job:
-				self.build_job(job)
+				try:
+					self.build_job(job)
+				except common.MaatError as e:
+					if not self.keep_going:
+						raise e
+					self.fail(job, e)
 				job = self.next()
+			self.check_failures()
 			if self.show_time:
 				self.ctx.print_success("all is fine (%s)!" % common.format_duration(self.total_time));
 			else:
 				self.ctx.print_success("all is fine!");
 			sign.save(self.ctx)
+			digest.save(self.ctx)
+			cache.save(self.ctx)
 		except common.MaatError as e:
 			sign.save(self.ctx)
+			digest.save(self.ctx)
+			cache.save(self.ctx)
 			raise e
 
 
+class StateLock(common.Lock):
+	"""Lock used by parallel build: the state of a suspended job
+	is made of the current environment, the environment stack and
+	the current directory."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		self.lock.acquire()
+
+	def release(self):
+		self.lock.release()
+
+	def state(self):
+		"""Get the current global state."""
+		return (maat.curenv, list(maat.envstack), os.getcwd())
+
+	def suspend(self):
+		state = self.state()
+		self.lock.release()
+		return state
+
+	def resume(self, state):
+		self.lock.acquire()
+		env, stack, cwd = state
+		maat.envstack[:] = stack
+		maat.set_env(env)
+		os.chdir(cwd)
+
+
 class ParBuilder(Builder):
-	"""Driver that executes build in parallel."""
+	"""Driver that executes build in parallel. Up to jobs jobs are
+	run at the same time by a pool of worker threads. The Python part of
+	the actions is executed with the global state lock taken while
+	waiting for commands is done with the lock released.
+
+	If a jobserver is used, a token is taken for each job run in addition
+	to the first one. When no token is available or when the machine is
+	overloaded, the launch of jobs is retried every POLL seconds."""
+	POLL = .05
+	runs = True
+
+	def __init__(self, ctx, targets, force):
+		Builder.__init__(self, ctx, targets, force)
+		self.lock = StateLock()
+		self.base = None
+		self.todo_queue = queue.Queue()
+		self.done_queue = queue.Queue()
+		self.running = 0
+		self.error = None
+		self.tokens = []
+		self.starving = False
+
+	def work(self):
+		"""Function executed by the worker threads."""
+		job = self.todo_queue.get()
+		while job:
+			self.lock.resume(self.base)
+			try:
+				if not job.target.is_hidden:
+					self.ctx.print_info("[%3d%%] Making %s" % (self.progress(), job.target))
+				job.build()
+				error = None
+			except Exception as e:
+				error = e
+			finally:
+				self.lock.release()
+			self.done_queue.put((job, error))
+			job = self.todo_queue.get()
+
+	def launch(self):
+		"""Launch the ready jobs while there are free workers."""
+		self.starving = False
+		while self.error == None and self.running < self.jobs and self.ready:
+			if self.running > 0 and throttle.overloaded():
+				self.starving = True
+				break
+			token = None
+			if self.running > 0 and jobserver.current != None:
+				token = jobserver.current.acquire()
+				if token == None:
+					self.starving = True
+					break
+			job = self.next()
+			if not job:
+				if token != None:
+					jobserver.current.release(token)
+				break
+			if token != None:
+				self.tokens.append(token)
+			job.ctx = copy.copy(self.ctx)
+			self.running = self.running + 1
+			self.todo_queue.put(job)
+
+	def end(self, job, error):
+		"""Called when a job is ended."""
+		self.running = self.running - 1
+		if self.tokens:
+			jobserver.current.release(self.tokens.pop())
+		if error != None and self.keep_going and self.error == None and isinstance(error, common.MaatError):
+			self.fail(job, error)
+		elif error != None:
+			self.release(job)
+			self.current.remove(job)
+			if self.error == None:
+				self.error = error
+				self.cancel()
+		else:
+			self.complete(job)
+			if not job.target.is_hidden and self.show_time:
+				self.ctx.print_info("[%3d%%] Made %s (%s)" % (self.progress(), job.target, common.format_duration(job.duration())))
+
+	def cancel(self):
+		"""Stop the commands of the running jobs (with the global lock
+		released to let the stopped jobs end)."""
+		state = self.lock.suspend()
+		try:
+			action.cancel()
+		finally:
+			self.lock.resume(state)
+
+	def wait(self):
+		"""Wait for a job to end. Return (job, error) or (None, None) if
+		a jobserver token or the load has to be checked again."""
+		state = self.lock.suspend()
+		try:
+			return self.done_queue.get(timeout = self.POLL if self.starving else None)
+		except queue.Empty:
+			return (None, None)
+		finally:
+			self.lock.resume(state)
+
+	def build(self):
+		old_lock = common.lock
+		common.lock = self.lock
+		self.lock.acquire()
+		self.base = self.lock.state()
+		workers = [threading.Thread(target = self.work, daemon = True) for i in range(self.jobs)]
+		for worker in workers:
+			worker.start()
+		try:
+			try:
+				self.launch()
+				while self.running:
+					job, error = self.wait()
+					if job != None:
+						self.end(job, error)
+					self.launch()
+			except KeyboardInterrupt as e:
+				self.error = e
+				self.cancel()
+				while self.running:
+					job, error = self.wait()
+					if job != None:
+						self.end(job, error)
+			for worker in workers:
+				self.todo_queue.put(None)
+			sign.save(self.ctx)
+			digest.save(self.ctx)
+			cache.save(self.ctx)
+			if self.error != None:
+				raise self.error
+			self.check_failures()
+			if self.show_time:
+				self.ctx.print_success("all is fine (%s)!" % common.format_duration(self.total_time));
+			else:
+				self.ctx.print_success("all is fine!");
+		finally:
+			for token in self.tokens:
+				jobserver.current.release(token)
+			self.tokens = []
+			self.lock.release()
+			common.lock = old_lock
@@ -120,6 +120,9 @@ class Linker(action.Action):
 			
 	def commands(self, cmds):
 		cmds.append("%s" % action.make_line(self.command()))
+
+	def signature(self):
+		return action.make_line(self.command())
 	
 def link_lib(ress, deps):
 	return [ress[0].AR, "rcs", ress[0], deps]
@@ -194,7 +197,7 @@ def parse_dep(path):
 	try:
 		f = open(str(path), "r")
 		buf = ""
-		for l in f.xreadlines():
+		for l in f:
 			buf = buf + l
 			if buf[-2:] == "\\\n":
 				buf = buf[:-2]
@@ -244,7 +247,13 @@ def make_objects(dir, sources, CFLAGS, CXXFLAGS, dyn = False):
 		added = added + " -MMD -MF %s" % df.relative_to_cur()
 		if added:
 			o.ADDED_FLAGS = added
-		parse_dep(df)	
+		o.DEP_FILE = df
+		deps = recipe.logged_deps(o)
+		if deps == None:
+			parse_dep(df)
+		else:
+			for dep in deps:
+				o.recipe.add_dep(file(dep))
 	return objs
 	
 
@@ -262,6 +271,7 @@ LIBS = None, RPATH = None, INSTALL_TO = ""):
 	
 	# build program
 	recipe.ActionRecipe([prog], objs, Linker(prog, objs, is_cxx(sources)))
+	prog.POOL = "link"
 	if LDFLAGS:
 		prog.LDFLAGS = LDFLAGS
 	if prog.BUILD_MODE != "":
@@ -313,6 +323,7 @@ LDFLAGS =  None, LIBS = None, RPATH = None, INSTALL_TO = "", DYN_INSTALL_TO = ""
 	if type in ["dynamic", "both"]:
 		lib = file(DYN_PREFIX + name + DYN_SUFFIX)
 		recipe.ActionRecipe([lib], objs, Linker(lib, objs, is_cxx(sources)))
+		lib.POOL = "link"
 		lib.ADDED_LDFLAGS = "-shared"
 		if LDFLAGS:
 			lib.LDFLAGS = LDFLAGS
@@ -0,0 +1,505 @@
+#	MAAT artifact cache module
+#	Copyright (C) 2016 H. Casse <hugues.casse@laposte.net>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module implements the cache of the results of the recipes.
+The results of a recipe are identified by a key computed from the
+signature of the recipe and from the paths and the contents of its
+dependencies. When a recipe has to be run, its results are first looked
+in the cache: if they are found, they are linked (or copied) in place of
+the results and the output of the action is displayed again.
+
+The cache is a directory containing:
+* objects/XX/HASH -- the content of the files, named by their hash,
+* entries/XX/KEY -- the description of the results of the recipe
+  matching KEY (hashes and modes of the files, output of the action).
+
+As the results may be hard links to the objects of the cache, they are
+removed before running an action so that a command writing its result
+in place does not change the cache.
+
+A remote cache may be shared by several machines. It is accessed with
+HTTP GET and PUT requests on the same layout as the local cache (URL/objects/XX/HASH
+and URL/entries/XX/KEY). The entries and objects got from the remote cache are
+recorded in the local cache. The remote cache may be read-only or read-write
+(the results of the recipes are then sent to it). As it must not slow down
+the build, the requests have a short timeout and the remote cache is no more
+used after an error.
+
+The number of hits and misses and the size of the cache are recorded
+in the stats file of the cache. At the end of a build, if the size is
+greater than the limit, the least recently used entries (whose date is
+changed at each use) are removed with the objects that are no more used."""
+
+import hashlib
+import http.client
+import json
+import os
+import re
+import shutil
+import stat
+import threading
+import urllib.error
+import urllib.request
+
+from maat import common
+from maat import digest
+from maat import env
+from maat import recipe
+
+
+path = None
+"""Path of the cache directory or None if the cache is disabled."""
+remote = None
+"""URL of the remote cache or None."""
+writable = False
+"""True if the results are sent to the remote cache."""
+TIMEOUT = 2
+"""Timeout (in seconds) of the requests to the remote cache."""
+limit = 10 << 30
+"""Maximum size (in bytes) of the local cache."""
+HASH = re.compile(r"[0-9a-f]{40}\Z")
+"""Regular expression of the hashes naming the objects."""
+
+hits = 0
+"""Number of hits of the current build."""
+misses = 0
+"""Number of misses of the current build."""
+added = 0
+"""Size added to the cache by the current build."""
+
+
+def default_path():
+	"""Get the default path of the cache directory."""
+	base = os.environ.get("XDG_CACHE_HOME")
+	if not base:
+		base = os.path.join(os.path.expanduser("~"), ".cache")
+	return os.path.join(base, "maat")
+
+
+def get_object(hash):
+	"""Get the name of the object with the given hash (in hexadecimal)."""
+	return "objects/%s/%s" % (hash[:2], hash)
+
+
+def get_entry(key):
+	"""Get the name of the entry with the given key."""
+	return "entries/%s/%s" % (key[:2], key)
+
+
+def get_dir():
+	"""Get the directory of the local cache (the default one if the
+	cache is disabled)."""
+	if path == None:
+		return default_path()
+	else:
+		return path
+
+
+def local(name):
+	"""Get the path in the local cache of the given name."""
+	return os.path.join(get_dir(), name)
+
+
+def fail(ctx, e):
+	"""Called when the remote cache fails: it is no more used."""
+	global remote
+	if remote != None:
+		ctx.print_warning("remote cache disabled: %s" % e)
+		remote = None
+
+
+def valid(entry):
+	"""Test if the given entry (read from JSON) is well-formed. As the
+	entries may come from the remote cache, the hashes are checked
+	before being used as object names."""
+	try:
+		return len(entry["outputs"]) == len(entry["modes"]) \
+			and all([isinstance(h, str) and HASH.match(h) for h in entry["outputs"]]) \
+			and all([isinstance(m, int) for m in entry["modes"]]) \
+			and isinstance(entry["out"], str) and isinstance(entry["err"], str)
+	except (KeyError, TypeError):
+		return False
+
+
+def check(name, data):
+	"""Test if the data received for the given name are valid: the
+	objects must match their hash and the entries must be well-formed."""
+	if name.startswith("objects/"):
+		return hashlib.sha1(data).hexdigest() == os.path.basename(name)
+	try:
+		return valid(json.loads(data.decode()))
+	except ValueError:
+		return False
+
+
+def pull(name, ctx):
+	"""Get the given name from the remote cache and record it in the
+	local cache. Return True if it is found."""
+	if remote == None:
+		return False
+	try:
+		with urllib.request.urlopen("%s/%s" % (remote, name), timeout = TIMEOUT) as r:
+			data = r.read()
+		if not check(name, data):
+			fail(ctx, "corrupted %s" % name)
+			return False
+		write(local(name), lambda tmp: write_bytes(tmp, data))
+		return True
+	except urllib.error.HTTPError as e:
+		if e.code != 404:
+			fail(ctx, e)
+		return False
+	except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+		fail(ctx, e)
+		return False
+
+
+def push(name, ctx):
+	"""Send the given name of the local cache to the remote cache."""
+	if remote == None or not writable:
+		return
+	try:
+		with open(local(name), "rb") as f:
+			data = f.read()
+		req = urllib.request.Request("%s/%s" % (remote, name), data = data, method = "PUT")
+		with urllib.request.urlopen(req, timeout = TIMEOUT):
+			pass
+	except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+		fail(ctx, e)
+
+
+def relative(p):
+	"""Get the given path relatively to the top directory (if it is
+	inside) so that the keys do not depend on the place of the project."""
+	p = str(p)
+	top = str(env.top.path)
+	if p.startswith(top + os.sep):
+		return p[len(top) + 1:]
+	else:
+		return p
+
+
+def outputs(file):
+	"""Get the paths of the files produced by the recipe of the given
+	file (the results and the dependency file if any)."""
+	paths = [str(r.actual()) for r in file.recipe.ress if not r.is_phony]
+	df = file.get_here("DEP_FILE")
+	if df != None:
+		paths.append(str(df))
+	return paths
+
+
+def key(file):
+	"""Compute the key of the recipe of the given file. Return None if
+	the cache is disabled or the recipe cannot be cached: no signature
+	or no result, dependencies that cannot be hashed, dependencies
+	discovered at build time (DEP_FILE) that are not known yet (no
+	dependency log and no dependency file). Only the path of directory
+	dependencies is taken into account and results that are directories
+	are not cached."""
+	if path == None or file.recipe == None:
+		return None
+	s = file.recipe.signature()
+	if not s or not [r for r in file.recipe.ress if not r.is_phony]:
+		return None
+	df = file.get_here("DEP_FILE")
+	if df != None and recipe.logged_deps(file) == None and common.stat_file(str(df)) == None:
+		return None
+	h = hashlib.sha1(s.encode())
+	for p in outputs(file):
+		h.update(("\nres %s" % relative(p)).encode())
+	for d in file.recipe.deps:
+		if d.is_phony or d.is_meta:
+			continue
+		h.update(("\ndep %s " % relative(d.actual())).encode())
+		if not common.is_dir_stat(common.stat(d.actual())):
+			c = digest.get(d.actual())
+			if c == None:
+				return None
+			h.update(c)
+	return h.hexdigest()
+
+
+def detach(file):
+	"""Remove the results of the recipe of the given file that are
+	hard links (possibly to the cache). Only regular files are concerned
+	as directories have always several links."""
+	for p in outputs(file):
+		s = common.stat_file(p)
+		if s != None and stat.S_ISREG(s.st_mode) and s.st_nlink > 1:
+			try:
+				os.remove(p)
+			except OSError as e:
+				common.error(str(e))
+
+
+def fetch(key, file, ctx):
+	"""Look for the results of the recipe of the given file in the
+	cache. If they are found, install them, display the output of the
+	action and return True. Else return False. The global lock is released
+	while accessing the files and the remote cache."""
+	global hits
+	global misses
+	paths = outputs(file)
+	state = common.lock.suspend()
+	try:
+		entry = get(key, ctx)
+		if entry == None:
+			misses = misses + 1
+			return False
+		if len(entry["outputs"]) != len(paths) or len(entry["modes"]) != len(paths):
+			misses = misses + 1
+			return False
+		for h in entry["outputs"]:
+			if not os.path.exists(local(get_object(h))) and not pull(get_object(h), ctx):
+				misses = misses + 1
+				return False
+		for p, h, mode in zip(paths, entry["outputs"], entry["modes"]):
+			install(local(get_object(h)), p, mode)
+		os.utime(local(get_entry(key)))
+	except (IOError, OSError):
+		misses = misses + 1
+		return False
+	finally:
+		common.lock.resume(state)
+	hits = hits + 1
+	ctx.out.write(entry["out"])
+	ctx.err.write(entry["err"])
+	return True
+
+
+def install(obj, p, mode):
+	"""Install the given object at the path p with the given mode (only
+	the permission bits are used). The object is linked if it has the
+	right mode, copied else."""
+	mode = mode & 0o777
+	if os.path.exists(p):
+		os.remove(p)
+	if os.stat(obj).st_mode & 0o777 == mode:
+		try:
+			os.link(obj, p)
+		except OSError:
+			shutil.copy(obj, p)
+	else:
+		shutil.copyfile(obj, p)
+		os.chmod(p, mode)
+	os.utime(p)
+
+
+def get(key, ctx):
+	"""Get the entry matching the given key from the local cache
+	or from the remote cache. Return None if there is no entry."""
+	name = get_entry(key)
+	if not os.path.exists(local(name)) and not pull(name, ctx):
+		return None
+	try:
+		with open(local(name)) as f:
+			entry = json.load(f)
+		if valid(entry):
+			return entry
+	except (IOError, OSError, ValueError):
+		pass
+	return None
+
+
+def store(key, file, ctx, out, err):
+	"""Store in the cache the results of the recipe of the given file
+	with the output of the action. Nothing is stored if a result is not
+	a regular file and errors are ignored: the cache is only an
+	optimization."""
+	global added
+	paths = outputs(file)
+	hashes = []
+	for p in paths:
+		common.invalidate(p)
+		h = digest.get(p)
+		if h == None:
+			return
+		hashes.append(h.hex())
+	state = common.lock.suspend()
+	try:
+		for p, h in zip(paths, hashes):
+			obj = get_object(h)
+			if not os.path.exists(local(obj)):
+				write(local(obj), lambda tmp: shutil.copy(p, tmp))
+				added = added + os.path.getsize(local(obj))
+			push(obj, ctx)
+		modes = [os.stat(p).st_mode & 0o777 for p in paths]
+		content = json.dumps({ "outputs": hashes, "modes": modes, "out": out, "err": err })
+		write(local(get_entry(key)), lambda tmp: write_text(tmp, content))
+		added = added + len(content)
+		push(get_entry(key), ctx)
+	except (IOError, OSError):
+		pass
+	finally:
+		common.lock.resume(state)
+
+
+def write(p, fun):
+	"""Write atomically the file of the cache with the given path
+	using fun to fill a temporary file."""
+	dir = os.path.dirname(p)
+	if not os.path.isdir(dir):
+		os.makedirs(dir, exist_ok = True)
+	tmp = "%s.%d.%d.tmp" % (p, os.getpid(), threading.get_ident())
+	try:
+		fun(tmp)
+		os.replace(tmp, p)
+	except (IOError, OSError) as e:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		raise e
+
+
+def write_text(p, text):
+	"""Write the given text in the file with the given path."""
+	with open(p, "w") as f:
+		f.write(text)
+
+
+def write_bytes(p, data):
+	"""Write the given bytes in the file with the given path."""
+	with open(p, "wb") as f:
+		f.write(data)
+
+
+class Recorder:
+	"""Stream recording the output written to another stream."""
+
+	def __init__(self, out):
+		self.out = out
+		self.text = ""
+
+	def write(self, text):
+		self.text = self.text + text
+		self.out.write(text)
+
+	def flush(self):
+		pass
+
+
+def load_stats():
+	"""Load the statistics of the cache."""
+	try:
+		with open(local("stats")) as f:
+			return json.load(f)
+	except (IOError, OSError, ValueError):
+		return { "hits": 0, "misses": 0, "size": None }
+
+
+def save_stats(stats):
+	"""Save the statistics of the cache."""
+	content = json.dumps(stats)
+	write(local("stats"), lambda tmp: write_text(tmp, content))
+
+
+def files(dir):
+	"""Get the list of (path, status) of the files in the given
+	directory of the cache."""
+	result = []
+	if not os.path.isdir(local(dir)):
+		return result
+	for sub in os.listdir(local(dir)):
+		for name in os.listdir(local(os.path.join(dir, sub))):
+			p = local(os.path.join(dir, sub, name))
+			try:
+				result.append((p, os.stat(p)))
+			except OSError:
+				pass
+	return result
+
+
+def usage():
+	"""Compute the number of entries and the size of the cache."""
+	entries = files("entries")
+	return (len(entries), sum([s.st_size for p, s in entries + files("objects")]))
+
+
+def collect(ctx, size):
+	"""Remove the least recently used entries and the objects they use
+	to decrease the size of the cache to the given size. Return the new
+	size of the cache."""
+	sizes = dict([(os.path.basename(p), s.st_size) for p, s in files("objects")])
+	entries = files("entries")
+	entries.sort(key = lambda e: e[1].st_mtime_ns, reverse = True)
+	used = { }
+	total = 0
+	removed = 0
+	for p, s in entries:
+		try:
+			with open(p) as f:
+				hashes = json.load(f)["outputs"]
+		except (IOError, OSError, ValueError, KeyError):
+			hashes = None
+		more = s.st_size + sum([sizes.get(h, 0) for h in hashes or [] if h not in used])
+		if hashes != None and total + more <= size:
+			total = total + more
+			for h in hashes:
+				used[h] = True
+		else:
+			os.remove(p)
+			removed = removed + 1
+	for h in sizes:
+		if h not in used:
+			os.remove(local(get_object(h)))
+	ctx.print_info("cache: %d entries removed, %s used" % (removed, common.format_size(total)))
+	return total
+
+
+def save(ctx):
+	"""Record the statistics of the current build and, if the cache is
+	too big, remove the least recently used entries."""
+	global hits
+	global misses
+	global added
+	if path == None or not (hits or misses or added):
+		return
+	try:
+		stats = load_stats()
+		stats["hits"] = stats["hits"] + hits
+		stats["misses"] = stats["misses"] + misses
+		if stats["size"] == None:
+			stats["size"] = usage()[1]
+		else:
+			stats["size"] = stats["size"] + added
+		hits = misses = added = 0
+		if stats["size"] > limit:
+			stats["size"] = collect(ctx, limit)
+		save_stats(stats)
+	except (IOError, OSError) as e:
+		ctx.print_warning("cannot update the cache: %s" % e)
+
+
+def show_stats(ctx):
+	"""Display the statistics of the cache."""
+	stats = load_stats()
+	count, size = usage()
+	total = stats["hits"] + stats["misses"]
+	ctx.print_def("path: ", get_dir())
+	ctx.print_def("entries: ", str(count))
+	ctx.print_def("size: ", "%s (limit %s)" % (common.format_size(size), common.format_size(limit)))
+	ctx.print_def("hits: ", "%d (%d%%)" % (stats["hits"], stats["hits"] * 100 / total if total else 0))
+	ctx.print_def("misses: ", "%d" % stats["misses"])
+
+
+def gc(ctx):
+	"""Reduce the size of the cache to the limit."""
+	try:
+		stats = load_stats()
+		stats["size"] = collect(ctx, limit)
+		save_stats(stats)
+	except (IOError, OSError) as e:
+		common.error("cannot collect the cache: %s" % e)
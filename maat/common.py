@@ -18,7 +18,9 @@
 
 import fnmatch
 import os
+import stat as pystat
 import sys
+import threading
 import time as pytime
 
 import maat.io
@@ -87,7 +89,8 @@ class Path:
 		return os.path.exists(self.path)
 
 	def get_mod_time(self):
-		return os.path.getmtime(self.path)
+		"""Get the modification time of the file (integer in ns)."""
+		return os.stat(self.path).st_mtime_ns
 		
 	def prefixed_by(self, path):
 		return self.path.startswith(str(path))
@@ -152,6 +155,93 @@ class Path:
 			os.makedirs(self.path)
 
 
+# file status cache
+stat_db = { }
+"""Cache of file status for the current build."""
+
+scanned = set()
+"""Directories whose content has been recorded in the status cache."""
+SCAN_IGNORE = [".git", ".hg", ".svn", "CVS", "__pycache__"]
+"""Directories ignored by scan()."""
+
+def stat(path):
+	"""Get the status (as returned by os.stat()) of the file matching
+	the given path or None if the file does not exist. The status
+	is obtained only once for the current build."""
+	path = str(path)
+	try:
+		return stat_db[path]
+	except KeyError:
+		if os.path.dirname(path) in scanned:
+			s = None
+		else:
+			s = stat_file(path)
+		stat_db[path] = s
+		return s
+
+def stat_file(path):
+	"""Get the status of the given path or None if the file doesn't exist
+	(without using the cache)."""
+	try:
+		return os.stat(path)
+	except OSError:
+		return None
+
+def prefetch(paths, jobs):
+	"""Get the status of the given paths using jobs threads and
+	record them in the status cache. This is useful to hide the latency
+	of network file systems."""
+	paths = [str(p) for p in paths]
+	paths = [p for p in paths if p not in stat_db and os.path.dirname(p) not in scanned]
+	def work(paths):
+		for path in paths:
+			stat_db[path] = stat_file(path)
+	threads = [threading.Thread(target = work, args = (paths[i::jobs], )) for i in range(jobs)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+def invalidate(path):
+	"""Remove the cached status of the given path (called when
+	the matching file is modified)."""
+	path = str(path)
+	stat_db.pop(path, None)
+	scanned.discard(os.path.dirname(path))
+
+def forget():
+	"""Empty the status cache (at the start of a new build)."""
+	stat_db.clear()
+	scanned.clear()
+
+def scan(path, ignore = SCAN_IGNORE):
+	"""Walk the directory tree starting at the given path and record
+	the status of all its entries in the status cache. Afterwards,
+	stat() for a file in one of these directories does not need
+	any system call."""
+	todo = [os.path.normpath(os.path.abspath(str(path)))]
+	while todo:
+		dir = todo.pop()
+		if dir in scanned:
+			continue
+		try:
+			with os.scandir(dir) as entries:
+				for entry in entries:
+					try:
+						stat_db[entry.path] = entry.stat()
+					except OSError:
+						stat_db[entry.path] = None
+					if entry.is_dir(follow_symlinks = False) and entry.name not in ignore:
+						todo.append(entry.path)
+		except OSError:
+			continue
+		scanned.add(dir)
+
+def is_dir_stat(s):
+	"""Test if the status returned by stat() designs a directory."""
+	return s != None and pystat.S_ISDIR(s.st_mode)
+
+
 # Filters
 class Filter:
 	"""A filter provide a way to test a path for a specific property."""
@@ -305,6 +395,27 @@ def format_duration(d):
 		return "%6.2fms" % (d * 1000)
 
 
+SIZE_UNITS = { "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40 }
+"""Units of sizes."""
+
+def parse_size(text):
+	"""Parse a size made of a number and an optional unit (K, M, G
+	or T). Raise ValueError if the size is not valid."""
+	text = text.strip().upper()
+	if text and text[-1] in SIZE_UNITS:
+		return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+	else:
+		return int(text)
+
+
+def format_size(size):
+	"""Format a size (in bytes) for user display."""
+	for u in ["T", "G", "M", "K"]:
+		if size >= SIZE_UNITS[u]:
+			return "%.1f%s" % (float(size) / SIZE_UNITS[u], u)
+	return "%d" % size
+
+
 def time():
 	"""Get the current time (in s)."""
 	return pytime.time()
@@ -355,3 +466,30 @@ class FunDelegate(Delegate):
 post_inits = []		# Processing to call just before building
 
 
+class Lock:
+	"""Lock protecting the global state of Maat (current environment,
+	current directory) while jobs are performed. Blocking operations,
+	like waiting for a command, suspend the lock to let other jobs run.
+	As a default, there is only one job running and the lock does nothing."""
+
+	def acquire(self):
+		"""Acquire the lock."""
+		pass
+
+	def release(self):
+		"""Release the lock."""
+		pass
+
+	def suspend(self):
+		"""Release the lock and return the global state of the current
+		job to be passed back to resume()."""
+		return None
+
+	def resume(self, state):
+		"""Acquire again the lock and re-install the given state."""
+		pass
+
+lock = Lock()
+"""Current global state lock."""
+
+
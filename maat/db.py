@@ -0,0 +1,121 @@
+#	MAAT database module
+#	Copyright (C) 2016 H. Casse <hugues.casse@laposte.net>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module provides the database recording the state of the build
+between runs (signatures, hashes of files, durations of jobs, etc).
+It is stored with SQLite in .maat/state.db: the records are looked up
+on demand and only the changed records are written.
+
+The database works in WAL mode: each commit is appended to a journal
+file (replayed when the database is open) that is regularly merged
+back in the database. Committing after each job is therefore cheap and
+ensures that an interrupted build resumes where it stopped."""
+
+import os.path
+import sqlite3
+
+import maat as m
+from maat import io
+
+SCHEMA = [
+	"CREATE TABLE IF NOT EXISTS signs (target TEXT PRIMARY KEY, sign TEXT)",
+	"CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, inode INTEGER, hash BLOB)",
+	"CREATE TABLE IF NOT EXISTS inputs (target TEXT, dep TEXT, hash BLOB, PRIMARY KEY (target, dep))",
+	"CREATE TABLE IF NOT EXISTS durations (target TEXT PRIMARY KEY, duration REAL)",
+	"CREATE TABLE IF NOT EXISTS deps (target TEXT, dep TEXT, PRIMARY KEY (target, dep))",
+	"CREATE TABLE IF NOT EXISTS memory (target TEXT PRIMARY KEY, memory INTEGER)"
+]
+"""Definition of the tables of the database."""
+
+connection = None
+"""Connection to the database."""
+path = None
+"""Path of the database."""
+read_only = False
+"""True if the state must not be changed (dry run, question mode): the
+database is open in read-only mode or, if it doesn't exist, in memory."""
+
+
+def open(ctx = io.DEF):
+	"""Open the database (if not already done). If the database cannot
+	be used, a warning is displayed and an in-memory database is used."""
+	global connection
+	global path
+	if connection != None:
+		return
+	path = str(m.temp() / "state.db")
+	if read_only:
+		try:
+			if os.path.exists(path):
+				connection = sqlite3.connect("file:%s?mode=ro" % path, uri = True, check_same_thread = False)
+				return
+		except sqlite3.Error as e:
+			pass
+		connection = sqlite3.connect(":memory:", check_same_thread = False)
+		for table in SCHEMA:
+			connection.execute(table)
+		return
+	try:
+		connection = sqlite3.connect(path, check_same_thread = False)
+		connection.execute("PRAGMA journal_mode = WAL")
+		connection.execute("PRAGMA synchronous = NORMAL")
+		for table in SCHEMA:
+			connection.execute(table)
+	except sqlite3.Error as e:
+		ctx.print_warning("state database cannot be open (%s). This may cause some unexpected recompilations." % e)
+		connection = sqlite3.connect(":memory:", check_same_thread = False)
+		for table in SCHEMA:
+			connection.execute(table)
+
+
+def query(sql, args = ()):
+	"""Perform a query and return the first row or None."""
+	return connection.execute(sql, args).fetchone()
+
+
+def query_all(sql, args = ()):
+	"""Perform a query and return the list of rows."""
+	return connection.execute(sql, args).fetchall()
+
+
+def execute(sql, args = ()):
+	"""Execute a modification of the database (ignored in read-only
+	mode)."""
+	if not read_only:
+		connection.execute(sql, args)
+
+
+def commit(ctx = io.DEF):
+	"""Write the modifications to the database. Nothing is done if the
+	database has been removed in between (by a clean goal for example)
+	or in read-only mode."""
+	if connection == None or read_only or not os.path.exists(path):
+		return
+	try:
+		connection.commit()
+	except sqlite3.Error as e:
+		ctx.print_warning("cannot save state database: %s." % e)
+
+
+def checkpoint(ctx = io.DEF):
+	"""Commit and merge the journal in the database."""
+	commit(ctx)
+	if connection == None or read_only or not os.path.exists(path):
+		return
+	try:
+		connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+	except sqlite3.Error as e:
+		ctx.print_warning("cannot save state database: %s." % e)
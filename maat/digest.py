@@ -0,0 +1,159 @@
+#	MAAT digest module
+#	Copyright (C) 2016 H. Casse <hugues.casse@laposte.net>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module supports update resolution based on file content.
+For each built target, the hashes of its dependencies are recorded and
+the target is only rebuilt if one of these hashes changes. To avoid
+computing hashes again and again, the hash of a file is kept with its
+modification time, size and inode and is only computed again if one
+of them changes."""
+
+import hashlib
+import mmap
+import threading
+
+from maat import common
+from maat import db
+from maat import io
+
+
+enabled = False
+"""True if update resolution is based on file content."""
+LARGE_SIZE = 1 << 20
+"""Size from which files are hashed in parallel by prepare()."""
+
+hashes = { }
+"""Map of file paths and (modification time, size, inode, hash)
+already looked up in the database."""
+
+
+def load(ctx = io.DEF):
+	"""Open the database containing the digests."""
+	db.open(ctx)
+
+
+def save(ctx = io.DEF):
+	"""Save the digests if needed."""
+	db.commit(ctx)
+
+
+def lookup(path):
+	"""Look for the recorded (modification time, size, inode, hash)
+	of the given path. Return None if there is no record."""
+	try:
+		return hashes[path]
+	except KeyError:
+		e = db.query("SELECT mtime, size, inode, hash FROM hashes WHERE path = ?", (path, ))
+		hashes[path] = e
+		return e
+
+
+def store(path, k, h):
+	"""Record the hash h of the path whose key is k."""
+	hashes[path] = k + (h, )
+	db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)", (path, ) + k + (h, ))
+
+
+def key(s):
+	"""Build the key identifying a file version from its status."""
+	return (s.st_mtime_ns, s.st_size, s.st_ino)
+
+
+def compute(path, size):
+	"""Compute the hash of the file matching the given path. Large
+	files are mapped in memory instead of being read."""
+	with open(path, "rb") as f:
+		if size < LARGE_SIZE:
+			return hashlib.sha1(f.read()).digest()
+		else:
+			with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as map:
+				return hashlib.sha1(map).digest()
+
+
+def get(path):
+	"""Get the hash of the file matching the given path. Return None
+	if the file doesn't exist or is not a regular file."""
+	path = str(path)
+	s = common.stat(path)
+	if s == None or common.is_dir_stat(s):
+		return None
+	k = key(s)
+	e = lookup(path)
+	if e != None and e[:3] == k:
+		return e[3]
+	try:
+		h = compute(path, s.st_size)
+	except (IOError, OSError, ValueError):
+		return None
+	store(path, k, h)
+	return h
+
+
+def prepare(paths, jobs):
+	"""Compute with jobs threads the hashes of the large files among
+	the given paths whose hash is not known (hashlib releases the
+	Python lock while hashing)."""
+	large = []
+	for path in paths:
+		path = str(path)
+		s = common.stat(path)
+		if s != None and not common.is_dir_stat(s) and s.st_size >= LARGE_SIZE:
+			e = lookup(path)
+			if e == None or e[:3] != key(s):
+				large.append((path, s))
+	results = []
+	def work(files):
+		for path, s in files:
+			try:
+				results.append((path, key(s), compute(path, s.st_size)))
+			except (IOError, OSError, ValueError):
+				pass
+	threads = [threading.Thread(target = work, args = (large[i::jobs], )) for i in range(jobs)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	for path, k, h in results:
+		store(path, k, h)
+
+
+def test(file, dep):
+	"""Test if the dependency dep of file changed since file has been
+	built. Return None if it cannot be decided from the file contents."""
+	if dep.is_phony or dep.is_meta:
+		return None
+	r = db.query("SELECT hash FROM inputs WHERE target = ? AND dep = ?", (str(file), str(dep)))
+	if r == None:
+		return None
+	c = get(dep.actual())
+	if r[0] == None or c == None:
+		return None
+	return c != r[0]
+
+
+def record(file):
+	"""Record the hashes of the dependencies the file is built from.
+	If update resolution is not based on file content, the hashes are
+	not computed but the old ones are removed as they are no more
+	the ones the file is built from."""
+	if file.recipe == None:
+		return
+	db.execute("DELETE FROM inputs WHERE target = ?", (str(file), ))
+	if not enabled:
+		return
+	for d in file.recipe.deps:
+		if not d.is_phony and not d.is_meta:
+			db.execute("INSERT OR REPLACE INTO inputs VALUES (?, ?, ?)", (str(file), str(d), get(d.actual())))
@@ -0,0 +1,175 @@
+#	MAAT engine module
+#	Copyright (C) 2016 H. Casse <hugues.casse@laposte.net>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module implements the engine supervising the commands launched
+by the actions. One thread runs an asyncio event loop that waits for
+the outputs and for the end of all the running commands. The outputs
+are read by chunks of CHUNK bytes and passed line by line to the streams
+of the action context.
+
+The end of a command is detected with a process file descriptor (on
+Linux) or by polling it every POLL seconds. The command is then waited
+with wait4() to get its peak memory. The thread that launched the
+command waits for its end on a future."""
+
+import asyncio
+import codecs
+import os
+import sys
+import threading
+
+CHUNK = 65536
+"""Size of the blocks read from the outputs of the commands."""
+POLL = .05
+"""Period (in seconds) of the polling of the commands without process
+file descriptor."""
+
+loop = None
+"""Event loop supervising the commands (started at the first command)."""
+loop_lock = threading.Lock()
+
+
+def get_loop():
+	"""Get the event loop, starting its thread if needed."""
+	global loop
+	with loop_lock:
+		if loop == None:
+			loop = asyncio.new_event_loop()
+			threading.Thread(target = loop.run_forever, daemon = True).start()
+		return loop
+
+
+class Output:
+	"""Output of a command read from a pipe and written to a stream.
+	The text is decoded incrementally as a chunk may end in the middle
+	of a character and is written line by line."""
+
+	def __init__(self, sup, file, stream):
+		self.sup = sup
+		self.file = file
+		self.fd = file.fileno()
+		self.stream = stream
+		self.decoder = codecs.getincrementaldecoder(sys.getdefaultencoding())("replace")
+		self.rest = ""
+		os.set_blocking(self.fd, False)
+		sup.loop.add_reader(self.fd, self.read)
+
+	def write(self, text):
+		"""Write text to the stream. The first error is recorded
+		and the next writes are ignored."""
+		if self.stream == None:
+			return
+		try:
+			self.stream.write(text)
+		except Exception as e:
+			self.stream = None
+			if self.sup.error == None:
+				self.sup.error = e
+
+	def read(self):
+		"""Called when the pipe is readable."""
+		try:
+			data = os.read(self.fd, CHUNK)
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError:
+			data = b""
+		lines = (self.rest + self.decoder.decode(data, not data)).split("\n")
+		self.rest = lines.pop()
+		for line in lines:
+			self.write(line + "\n")
+		if not data:
+			if self.rest:
+				self.write(self.rest)
+			self.sup.loop.remove_reader(self.fd)
+			self.file.close()
+			self.sup.outputs.remove(self)
+			self.sup.check()
+
+
+class Supervisor:
+	"""Supervisor of a running command. The future receives the couple
+	(exit code, peak memory in bytes) when the outputs are closed and
+	the command has ended."""
+
+	def __init__(self, loop, proc, streams, future):
+		self.loop = loop
+		self.proc = proc
+		self.future = future
+		self.error = None
+		self.result = None
+		self.outputs = []
+		for file, stream in streams:
+			self.outputs.append(Output(self, file, stream))
+		try:
+			self.pidfd = os.pidfd_open(proc.pid)
+			self.loop.add_reader(self.pidfd, self.reap)
+		except (AttributeError, OSError):
+			self.pidfd = None
+			self.loop.call_later(POLL, self.reap)
+
+	def reap(self):
+		"""Called when the command may have ended."""
+		try:
+			pid, status, usage = os.wait4(self.proc.pid, os.WNOHANG)
+		except ChildProcessError as e:
+			self.error = e
+			pid, status, usage = self.proc.pid, 0, None
+		if pid == 0:
+			if self.pidfd == None:
+				self.loop.call_later(POLL, self.reap)
+			return
+		if self.pidfd != None:
+			self.loop.remove_reader(self.pidfd)
+			os.close(self.pidfd)
+		if usage == None:
+			self.result = (-1, 0)
+		else:
+			self.result = (exit_code(status), usage.ru_maxrss * 1024)
+		self.check()
+
+	def check(self):
+		"""Complete the future if the command is ended."""
+		if self.outputs or self.result == None or self.future.done():
+			return
+		if self.error != None:
+			self.future.set_exception(self.error)
+		else:
+			self.future.set_result(self.result)
+
+
+def exit_code(status):
+	"""Get the exit code from the status returned by wait4() (negative
+	signal number if the process has been killed)."""
+	if os.WIFSIGNALED(status):
+		return -os.WTERMSIG(status)
+	else:
+		return os.WEXITSTATUS(status)
+
+
+async def supervise(proc, streams):
+	loop = asyncio.get_event_loop()
+	future = loop.create_future()
+	Supervisor(loop, proc, streams, future)
+	return await future
+
+
+def run(proc, streams):
+	"""Supervise the given process (subprocess.Popen) whose outputs are
+	written to the streams given as a list of (pipe, stream) couples.
+	Return a concurrent future giving the exit code and the peak memory
+	of the process."""
+	return asyncio.run_coroutine_threadsafe(supervise(proc, streams), get_loop())
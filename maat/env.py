@@ -89,6 +89,9 @@ class Env:
 	def __ne__(self, e):
 		return id(self) != id(e)
 
+	def __hash__(self):
+		return id(self)
+
 	def __lt__(self, e):
 		return id(self) < id(e)
 		
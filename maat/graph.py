@@ -0,0 +1,189 @@
+#	MAAT graph cache module
+#	Copyright (C) 2016 H. Casse <hugues.casse@laposte.net>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module implements the cache of the build graph. After a successful
+build, the files, their flags, the dependencies and the signatures of
+the recipes are saved in .maat/graph, with a key computed from the content
+of the scripts, of the configuration and of the command line definitions.
+
+At the next run, if the key matches, the graph is restored without running
+the scripts and the update test is performed on it. If nothing but goals
+without action has to be made, the build ends there. Otherwise, the
+restored graph is dropped and the scripts are run as usual (actions cannot
+be saved as they may contain any Python code)."""
+
+import hashlib
+import marshal
+import os.path
+import sys
+
+import maat as m
+from maat import action
+from maat import common
+from maat import env
+from maat import recipe
+
+VERSION = 1
+"""Version of the graph file format."""
+
+scripts = [os.path.abspath(sys.argv[0])]
+"""Paths of the loaded scripts."""
+
+
+class CachedRecipe(recipe.Recipe):
+	"""Recipe restored from the graph cache. It only provides the
+	signature of the original recipe and tells if this one has an
+	action."""
+
+	def __init__(self, ress, deps, sign, active, cwd):
+		recipe.Recipe.__init__(self, ress, deps)
+		self.sign = sign
+		self.active = active
+		self.cwd = common.Path(cwd)
+
+	def signature(self):
+		return self.sign
+
+
+def is_active(r):
+	"""Test if the given recipe has an action to perform."""
+	if isinstance(r, recipe.ActionRecipe):
+		return type(r.get_action()) != action.Action
+	else:
+		return type(r) != recipe.Recipe
+
+
+def get_path():
+	"""Get the path of the graph file."""
+	return m.temp() / "graph"
+
+
+def compute_key(paths, defs):
+	"""Compute the key from the content of the given paths and the
+	given definitions."""
+	h = hashlib.sha1(("%s %s\n" % (m.version, VERSION)).encode())
+	for d in sorted(defs):
+		h.update(("%s\n" % d).encode())
+	for p in paths:
+		h.update(("%s\n" % p).encode())
+		try:
+			with open(p, "rb") as f:
+				h.update(f.read())
+		except (IOError, OSError):
+			h.update(b"\0")
+	return h.digest()
+
+
+def config_path():
+	"""Get the path of the configuration file."""
+	return str(env.topdir / "config.py")
+
+
+def logged(f):
+	"""Get the files recorded for f in the dependency log."""
+	if recipe.dep_log == None:
+		return []
+	else:
+		return [recipe.get_file(d) for d in recipe.dep_log.get(str(f.path), [])]
+
+
+def save(defs):
+	"""Save the current graph."""
+	env.top.path.set_cur()
+	files = { }
+	def num(f):
+		if f not in files:
+			files[f] = len(files)
+		return files[f]
+
+	# build the recipe table (with logged dependencies)
+	recipes = set()
+	rtab = []
+	for f in list(recipe.file_db.values()):
+		r = f.recipe
+		if r != None and r not in recipes:
+			recipes.add(r)
+			deps = list(r.deps)
+			for res in r.ress:
+				for d in logged(res):
+					if d not in deps:
+						deps.append(d)
+			rtab.append((
+				[num(f) for f in r.ress],
+				[num(f) for f in deps],
+				r.signature(),
+				is_active(r),
+				str(r.cwd)))
+
+	# build the file table
+	names = dict([(n, num(f)) for n, f in recipe.file_db.items()])
+	ftab = [None] * len(files)
+	for f, i in files.items():
+		ftab[i] = (
+			str(f.path),
+			str(f.actual()),
+			(f.is_sticky, f.is_phony, f.is_meta, f.is_hidden, f.is_target, f.is_goal))
+
+	# save all
+	paths = scripts + [config_path()]
+	try:
+		with open(str(get_path()), "wb") as out:
+			marshal.dump((VERSION, compute_key(paths, defs), paths, ftab, rtab, names), out)
+	except (IOError, OSError) as e:
+		common.error("cannot save graph cache: %s" % e)
+
+
+def remove():
+	"""Remove the saved graph."""
+	try:
+		os.remove(str(get_path()))
+	except OSError:
+		pass
+
+
+def load(defs):
+	"""Restore the saved graph if its key matches. Return True if the
+	graph has been restored, False else."""
+	p = get_path()
+	try:
+		with open(str(p), "rb") as f:
+			version, key, paths, ftab, rtab, names = marshal.load(f)
+	except (IOError, OSError, EOFError, ValueError, TypeError):
+		return False
+	if version != VERSION or key != compute_key(paths, defs):
+		return False
+
+	# rebuild the files
+	files = []
+	for path, actual, flags in ftab:
+		f = recipe.File(common.Path(path))
+		f.actual_path = common.Path(actual)
+		files.append(f)
+
+	# rebuild the recipes
+	for ress, deps, sign, active, cwd in rtab:
+		CachedRecipe([files[i] for i in ress], [files[i] for i in deps], sign, active, cwd)
+	for (path, actual, flags), f in zip(ftab, files):
+		f.is_sticky, f.is_phony, f.is_meta, f.is_hidden, f.is_target, f.is_goal = flags
+	for n, i in names.items():
+		recipe.file_db[n] = files[i]
+	return True
+
+
+def reset():
+	"""Drop the restored graph."""
+	recipe.file_db.clear()
+	recipe.reset_updates()
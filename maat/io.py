@@ -82,6 +82,7 @@ class Context:
 	complete_quiet = False
 	action = None
 	flushed = False
+	memory = 0
 	
 	def handle_action(self):
 		"""Manage a pending action display."""
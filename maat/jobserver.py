@@ -0,0 +1,137 @@
+#	MAAT jobserver module
+#	Copyright (C) 2016 H. Casse <hugues.casse@laposte.net>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module implements the jobserver protocol of GNU make. A jobserver
+is a pipe (or a named pipe) containing one byte, a token, per job that
+can be run in addition to the first one. Before running a job, a process
+takes a token from the pipe and gives it back when the job is done.
+
+If Maat is run by make, it finds the jobserver in the MAKEFLAGS variable
+and uses it for the jobs of a parallel build. Else, when it performs
+a parallel build, it creates a jobserver that is passed to the commands
+(typically sub-makes) it launches."""
+
+import os
+import re
+
+from maat import io
+
+
+class Jobserver:
+	"""A jobserver made of a reading and a writing file descriptors.
+	The tokens are read in non-blocking mode from a separate file
+	descriptor (when possible) to not change the mode of the file
+	descriptors of the other processes."""
+
+	def __init__(self, r, w, inherited = True):
+		self.r = r
+		self.w = w
+		self.inherited = inherited
+		try:
+			self.nr = os.open("/proc/self/fd/%d" % r, os.O_RDONLY | os.O_NONBLOCK)
+		except OSError:
+			self.nr = r
+			os.set_blocking(r, False)
+
+	def acquire(self):
+		"""Get a token or None if no token is available."""
+		try:
+			return os.read(self.nr, 1) or None
+		except (BlockingIOError, InterruptedError):
+			return None
+
+	def release(self, token):
+		"""Give back a token."""
+		os.write(self.w, token)
+
+	def fds(self):
+		"""Get the file descriptors to pass to the launched commands."""
+		if self.inherited:
+			return (self.r, self.w)
+		else:
+			return ()
+
+
+current = None
+"""Jobserver in use or None."""
+
+
+def parse(flags):
+	"""Look for a jobserver in the given MAKEFLAGS. Return a couple
+	(reading, writing) file descriptors, a named pipe path or None."""
+	m = re.search(r"--jobserver-(?:auth|fds)=(\S+)", flags)
+	if m == None:
+		return None
+	auth = m.group(1)
+	if auth.startswith("fifo:"):
+		return auth[5:]
+	try:
+		r, w = auth.split(",")
+		return (int(r), int(w))
+	except ValueError:
+		return None
+
+
+def get_jobs():
+	"""Get the number of jobs given in MAKEFLAGS (or the number of
+	processors if it is not given)."""
+	m = re.search(r"(?:^| )-j(\d+)", os.environ.get("MAKEFLAGS", ""))
+	if m == None:
+		return os.cpu_count()
+	else:
+		return int(m.group(1))
+
+
+def connect(ctx = io.DEF):
+	"""Use the jobserver given in MAKEFLAGS if any. Return True if
+	a jobserver is used."""
+	global current
+	auth = parse(os.environ.get("MAKEFLAGS", ""))
+	if auth == None:
+		return False
+	try:
+		if isinstance(auth, str):
+			current = Jobserver(os.open(auth, os.O_RDONLY | os.O_NONBLOCK), os.open(auth, os.O_WRONLY), False)
+		else:
+			os.fstat(auth[0])
+			os.fstat(auth[1])
+			current = Jobserver(auth[0], auth[1])
+		return True
+	except OSError as e:
+		ctx.print_warning("jobserver of make is not available (%s): is the rule prefixed by '+'?" % e)
+		return False
+
+
+def create(jobs):
+	"""Create a jobserver for the given number of jobs and export it
+	in MAKEFLAGS for the launched commands."""
+	global current
+	r, w = os.pipe()
+	os.write(w, b"+" * (jobs - 1))
+	current = Jobserver(r, w)
+	flags = os.environ.get("MAKEFLAGS", "")
+	flags = re.sub(r"(^| )-j\S*| --jobserver-\S*", "", flags).strip()
+	flags = flags.split(" -- ", 1)
+	flags[0] = ("%s -j%d --jobserver-auth=%d,%d" % (flags[0], jobs, r, w)).strip()
+	os.environ["MAKEFLAGS"] = " -- ".join(flags)
+
+
+def fds():
+	"""Get the file descriptors to pass to the launched commands."""
+	if current == None:
+		return ()
+	else:
+		return current.fds()
@@ -21,12 +21,18 @@ import sys
 
 from maat import action
 import maat.common as common
+import maat.db as db
+import maat.digest as digest
 import maat.env as env
 import maat.io as io
 import maat.sign as sign
 
 file_db = { }		# file database
 ext_db = { }		# extension database
+update_db = { }		# cache of update tests (for the current build)
+collected = set()	# files already visited by collect_updates()
+unchanged = set()	# files rebuilt with an unchanged content
+dep_log = None		# log of discovered dependencies (target -> dependencies)
 
 
 # base classes
@@ -104,7 +110,7 @@ class File(env.MapEnv):
 		return self.path / str(arg)
 	
 	def time(self):
-		"""Get the last update time of the file."""
+		"""Get the last update time of the file (integer in ns)."""
 		if self.is_goal:
 			return 0
 		elif self.is_meta:
@@ -113,17 +119,39 @@ class File(env.MapEnv):
 			else:
 				return 0 
 		else:
-			return self.actual().get_mod_time()
+			s = self.stat()
+			if s == None:
+				return 0
+			else:
+				return s.st_mtime_ns
+
+	def stat(self):
+		"""Get the status of the actual file (as returned by os.stat())
+		or None if it doesn't exist. The status is cached for the build."""
+		return common.stat(self.actual())
 	
 	def younger_than(self, f):
 		"""Test if the current file is younger than the given one."""
-		if (not f.is_meta and not f.is_phony) and not f.actual().exists():
+		s = f.stat()
+		if (not f.is_meta and not f.is_phony) and s == None:
 			return True
-		elif f.actual().is_dir():
+		elif common.is_dir_stat(s):
 			return False
 		else:
 			return self.time() < f.time()
 
+	def changed(self, f):
+		"""Test if the dependency f changed since the current file
+		has been built: either f is younger or, in content mode,
+		the content of f changed."""
+		if f in unchanged:
+			return False
+		if digest.enabled:
+			r = digest.test(self, f)
+			if r != None:
+				return r
+		return self.younger_than(f)
+
 	def needs_update(self):
 		"""Test if the current file needs to be updated:
 		* it doesn't have a recipe
@@ -133,7 +161,7 @@ class File(env.MapEnv):
 		if self.is_goal or self.is_phony:
 			#print "DEBUG: %s updated because it is phony!" % self
 			return True
-		elif not self.actual().exists():
+		elif self.stat() == None:
 			if self.recipe != None:
 				#print "DEBUG: %s updated because it doesn't exist!" % self
 				return True
@@ -146,21 +174,49 @@ class File(env.MapEnv):
 			return True
 		else:
 			for d in self.recipe.deps:
-				if d.needs_update() or self.younger_than(d):
+				if d.check_update() or self.changed(d):
 					#print "DEBUG: %s updated because it is younger than %s!" % (self, d)
 					return True
 			return False
 
+	def check_update(self):
+		"""Same as needs_update() but the result is computed only once
+		for the current build."""
+		try:
+			return update_db[self]
+		except KeyError:
+			r = self.needs_update()
+			update_db[self] = r
+			return r
+
+	def invalidate(self):
+		"""Invalidate the information cached about the file
+		(called each time the file is built)."""
+		update_db.pop(self, None)
+		common.invalidate(self.actual())
+
 	def collect_updates(self, targets):
 		"""Collect the files that needs to be updated and store them
 		in the targets list."""
+		if self in collected:
+			return
+		collected.add(self)
 		if self.recipe:
 			for d in self.recipe.deps:
 				d.collect_updates(targets)
-		if self not in targets and self.needs_update():
+		if self.check_update():
 			targets.append(self)
-			
+
 	
+	def collect_files(self, files):
+		"""Collect in the files set the current file and all the files
+		it depends on."""
+		if self not in files:
+			files.add(self)
+			if self.recipe:
+				for d in self.recipe.deps:
+					d.collect_files(files)
+
 	def collect_all(self, targets):
 		"""Collect all the files that may be made."""
 		if self.recipe and self not in targets:
@@ -183,6 +239,15 @@ class File(env.MapEnv):
 		self.recipe.deps.append(dep)
 
 
+def actual_files(goals):
+	"""Get the actual paths of the (non-phony) files used to build
+	the given goals."""
+	files = set()
+	for goal in goals:
+		goal.collect_files(files)
+	return [f.actual() for f in files if not f.is_phony]
+
+
 def add_alias(file, name):
 	"""Add an alias for the given file with the given name."""
 	file_db[name] = file
@@ -453,7 +518,7 @@ def gen(dir, rext, dep):
 	kern = dir / n
 
 	# initialize lookup process
-	if not ext_db.has_key(dext):
+	if dext not in ext_db:
 		common.script_error("don't know how to build '%s' from '%s'" % (rext, dep))
 		#raise Common.MaatError("DEBUG:")
 	ext = ext_db[dext]
@@ -557,3 +622,63 @@ def parse_deps(path):
 							t.recipe.add_dep(d)
 	except IOError as e:
 		pass
+
+
+def reset_updates():
+	"""Forget the results of the update tests (at the start of
+	a new build)."""
+	update_db.clear()
+	collected.clear()
+	unchanged.clear()
+
+
+def read_deps(path):
+	"""Read a dependency file in Makefile format (as produced by
+	compilers) and return the list of dependency paths it contains."""
+	with open(str(path), "r") as f:
+		text = f.read().replace("\\\n", " ")
+	deps = []
+	for l in text.splitlines():
+		p = l.find(":")
+		if p >= 0:
+			deps = deps + l[p + 1:].split()
+	return deps
+
+
+def fold_deps(file):
+	"""If the file has a DEP_FILE variable, record the dependencies
+	found in this file in the dependency log and add them to the recipe
+	(for the next builds of a resident process). The relative paths are
+	interpreted relatively to the working directory of the recipe."""
+	df = file.get_here("DEP_FILE")
+	if df == None or file.recipe == None:
+		return
+	try:
+		deps = read_deps(df)
+	except (IOError, OSError):
+		return
+	cwd = str(file.recipe.cwd)
+	deps = [os.path.normpath(os.path.join(cwd, d)) for d in deps]
+	db.execute("DELETE FROM deps WHERE target = ?", (str(file.path), ))
+	for d in deps:
+		db.execute("INSERT OR REPLACE INTO deps VALUES (?, ?)", (str(file.path), d))
+	if dep_log != None:
+		dep_log[str(file.path)] = deps
+	for d in deps:
+		file.recipe.add_dep(get_file(d))
+
+
+def logged_deps(file):
+	"""Get the list of dependency paths recorded in the dependency log
+	for the given file or None if there is no record. The whole log is
+	read at the first call."""
+	global dep_log
+	if dep_log == None:
+		db.open()
+		dep_log = { }
+		for target, dep in db.query_all("SELECT target, dep FROM deps"):
+			try:
+				dep_log[target].append(dep)
+			except KeyError:
+				dep_log[target] = [dep]
+	return dep_log.get(str(file.path))
@@ -0,0 +1,205 @@
+#	MAAT build server module
+#	Copyright (C) 2016 H. Casse <hugues.casse@laposte.net>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module implements the build server. The server is a process
+that has run the scripts and keeps the build graph, the status of files
+and the state database in memory. It listens on a Unix socket in .maat
+and performs the builds requested by the clients, the output of the build
+being sent back to the client.
+
+The requests and the replies are JSON objects, one per line. A request
+contains the goals and the definitions of the command line. The server
+replies with "out" and "err" messages containing the output and ends
+with an "exit" message containing the return code. If the scripts
+have changed or the definitions are not the ones of the server, the server
+replies with "reload" and executes again itself: the client has just
+to wait for the new server and to send again its request (until
+RELOAD_TIMEOUT, even if a connection is lost while the server reloads)."""
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import maat as m
+from maat import common
+from maat import env
+from maat import graph
+from maat import io
+
+RELOAD_TIMEOUT = 60
+"""Time (in seconds) to wait for the server to reload."""
+
+
+def get_path():
+	"""Get the path of the server socket."""
+	return m.temp() / "server.sock"
+
+
+class ClientStream:
+	"""Stream sending its output to the client."""
+
+	def __init__(self, conn, kind, lock):
+		self.conn = conn
+		self.kind = kind
+		self.lock = lock
+
+	def write(self, text):
+		send(self.conn, { self.kind: text }, self.lock)
+
+	def flush(self):
+		pass
+
+
+def send(conn, msg, lock = None):
+	"""Send a message on the given connection. Errors are ignored as
+	the client may have been interrupted."""
+	data = (json.dumps(msg) + "\n").encode()
+	try:
+		if lock == None:
+			conn.sendall(data)
+		else:
+			with lock:
+				conn.sendall(data)
+	except OSError:
+		pass
+
+
+def receive(f):
+	"""Receive a message from the given file or None if the connection
+	is closed."""
+	try:
+		line = f.readline()
+		if not line:
+			return None
+		return json.loads(line.decode())
+	except (OSError, ValueError):
+		return None
+
+
+def stamp(path):
+	"""Get the modification time of the given path or None."""
+	s = common.stat_file(path)
+	if s == None:
+		return None
+	else:
+		return s.st_mtime_ns
+
+
+def stamps():
+	"""Get the modification times of the scripts and of the
+	configuration."""
+	return [(p, stamp(p)) for p in graph.scripts + [graph.config_path()]]
+
+
+def reload(defs):
+	"""Execute again the server with the given definitions."""
+	args = [a for a in sys.argv[1:] if a.startswith("-") or "=" not in a]
+	os.chdir(str(env.top.path))
+	os.execv(sys.executable, [sys.executable, graph.scripts[0]] + args + defs)
+
+
+def serve(ctx, defs, build):
+	"""Run the server. The server has been launched with the given
+	definitions and build is the function called to perform a build
+	with the goals, the output context and that returns the exit code."""
+	path = str(get_path())
+	if os.path.exists(path):
+		try:
+			s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			s.connect(path)
+			s.close()
+			common.error("a server is already running on %s" % path)
+		except ConnectionRefusedError:
+			os.remove(path)
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	sock.bind(path)
+	sock.listen()
+	ctx.print_info("server listening on %s" % path)
+	init = stamps()
+	try:
+		while True:
+			conn, addr = sock.accept()
+			with conn:
+				req = receive(conn.makefile("rb"))
+				if req == None:
+					continue
+				if req.get("defs", []) != defs or stamps() != init:
+					sock.close()
+					os.remove(path)
+					send(conn, { "reload": True })
+					conn.close()
+					reload(req.get("defs", []))
+				lock = threading.Lock()
+				out = ClientStream(conn, "out", lock)
+				err = ClientStream(conn, "err", lock)
+				old_out, old_err = sys.stdout, sys.stderr
+				sys.stdout, sys.stderr = out, err
+				try:
+					r = build(req.get("goals", []), out, err)
+				finally:
+					sys.stdout, sys.stderr = old_out, old_err
+				send(conn, { "exit": r })
+	finally:
+		sock.close()
+		if os.path.exists(path):
+			os.remove(path)
+
+
+def connect(goals, defs):
+	"""Ask the server to build the given goals with the given
+	definitions. Return the exit code."""
+	path = str(get_path())
+	req = (json.dumps({ "goals": goals, "defs": defs }) + "\n").encode()
+	timeout = None
+	while True:
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			sock.connect(path)
+		except OSError:
+			sock.close()
+			if timeout == None:
+				io.DEF.print_error("no server running (start it with --server)")
+				return 1
+			elif time.time() > timeout:
+				io.DEF.print_error("server does not restart")
+				return 1
+			time.sleep(.1)
+			continue
+		with sock:
+			sock.sendall(req)
+			f = sock.makefile("rb")
+			while True:
+				msg = receive(f)
+				if msg == None:
+					if timeout != None and time.time() <= timeout:
+						time.sleep(.1)
+						break
+					io.DEF.print_error("connection with the server lost")
+					return 1
+				elif "out" in msg:
+					sys.stdout.write(msg["out"])
+					sys.stdout.flush()
+				elif "err" in msg:
+					sys.stderr.write(msg["err"])
+					sys.stderr.flush()
+				elif "exit" in msg:
+					return msg["exit"]
+				elif "reload" in msg:
+					timeout = time.time() + RELOAD_TIMEOUT
+					break
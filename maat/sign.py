@@ -19,104 +19,62 @@ is the trace of actions needed to realize the recipe. The signature is
 used to detect cases when configuration changed and a recipe needs
 to be rebuilt accordingly: the action used to build it are changed."""
 
-import maat as m
-from maat import io
 import marshal
+import os
 
+import maat as m
+from maat import db
+from maat import io
 
-signs = None
-"""Map of tiles and signatures."""
-update = False
-"""True if signatures need to be updated."""
 
 def load(ctx = io.DEF):
-	"""Load the signature file, from .maat/signatures."""
-	global signs
-	global update
-	global maat_dir
-	
+	"""Open the signature database. Signatures of the old signature file,
+	.maat/signs, are imported in the database (not in read-only mode)."""
+	db.open(ctx)
 	p = m.temp() / "signs"
-	signs = { }
-	if not p.exists():
-		update = True
-	else:
+	if p.exists() and not db.read_only:
 		try:
 			f = open(str(p), "rb")
 			v = marshal.load(f)
-			if not isinstance(v, dict):
-				raise IOError("bad file content")
-			signs = v
-			#for k in signs.keys():
-			#	print "DEBUG sign %s: %s" % (k, signs[k])
-		except IOError as e:
-			ctx.print_warning("signature file cannot be open (%s). This may cause some unexpected recompilations." % e)
-			update = True
+			f.close()
+			if isinstance(v, dict):
+				for k in v:
+					db.execute("INSERT OR REPLACE INTO signs VALUES (?, ?)", (k, v[k]))
+			db.commit(ctx)
+			os.remove(str(p))
+		except (IOError, EOFError, ValueError) as e:
+			ctx.print_warning("old signature file cannot be imported (%s). This may cause some unexpected recompilations." % e)
 
 
 def save(ctx = io.DEF):
-	"""Save the signatures if needed."""
-	global signs
-	global update
-	
-	# nothing to do
-	if not update:
-		#print "DEBUG: no need to save signs"
-		return
-	
-	# save the file
-	#print "DEBUG: saving signs %s" % signs
-	p = m.temp() / "signs"
-	try:
-		f = open(str(p), "wb")
-		marshal.dump(signs, f)
-	except IOError as e:
-		ctx.print_warning("cannot save signature file: %s." % e)
+	"""Save the signatures if needed (at the end of the build)."""
+	db.checkpoint(ctx)
 	
 
+def get(file):
+	"""Get the recorded signature of the file or None."""
+	r = db.query("SELECT sign FROM signs WHERE target = ?", (str(file), ))
+	if r == None:
+		return None
+	else:
+		return r[0]
+
+
 def test(file):
 	"""Test if a signature is ok. Return true if it is ok, false else."""
-	global signs
-	global update
-	#print "DEBUG: %s" % signs
 
 	# no recipe: no need for signature
 	if not file.recipe:
 		return True
 
-	try:
-
-		# test the signature
-		s = file.recipe.signature()
-		k = str(file)
-		ss = signs[str(file)]
-		if s == ss:
-			return True
-
-		# signature does not match
-		else:
-			#print "DEBUG: sign of %s (%s) does not match %s" % (k, s, signs[k])
-			return False
-	
-	# no signature available
-	except KeyError as e:
-		#print "DEBUG: %s has no signature!" % k
-		return False
+	# test the signature
+	return file.recipe.signature() == get(file)
 
 
 def record(file):
 	"""Record the signature for making the given file."""
-	global signs
-	global update
-	
 	if file.recipe == None:
 		return
-	k = str(file)
 	s = file.recipe.signature()
-	try:
-		ss = signs[k]
-	except KeyError:
-		ss = None
-	if s != ss:
-		signs[k] = s
-		update = True
-		#print "DEBUG: record signature of %s (%s)" % (k, s)
+	if s != get(file):
+		db.execute("INSERT OR REPLACE INTO signs VALUES (?, ?)", (str(file), s))
@@ -19,7 +19,9 @@ goals:
   - all -- build all,
   - clean -- cleanup temporaries files,
   - distclean -- clean all what is built,
-  - install -- install programs.
+  - install -- install programs,
+  - cache-stats -- display statistics of the cache of results,
+  - cache-gc -- reduce the cache of results to its size limit.
 
 And some useful variables:
   - ALL -- list of files to build,
@@ -38,6 +40,7 @@ import shutil
 
 import maat
 from maat import action
+from maat import cache
 from maat import common
 from maat import config
 from maat import env
@@ -87,6 +90,14 @@ def install_default_goals():
 		g = maat.goal("dist", ["setup-dist", "install"])
 		g.DESCRIPTION = "build a binary distribution"
 
+	# install cache goals
+	if env.top.path / "cache-stats" not in recipe.file_db:
+		g = maat.goal("cache-stats", [], maat.fun(cache.show_stats))
+		g.DESCRIPTION = "display statistics of the cache of results"
+	if env.top.path / "cache-gc" not in recipe.file_db:
+		g = maat.goal("cache-gc", [], maat.fun(cache.gc))
+		g.DESCRIPTION = "reduce the cache of results to its size limit"
+
 	# set the default variable
 	config.set_if("BUILD_MODE", lambda : "Debug")
 	config.set_comment("BUILD_MODE", "one of Debug or Release")
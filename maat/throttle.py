@@ -0,0 +1,87 @@
+#	MAAT throttle module
+#	Copyright (C) 2016 H. Casse <hugues.casse@laposte.net>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module adapts the number of jobs of a parallel build to the
+load of the machine. New jobs are delayed while the load average is
+greater than max_load or while the available memory is lower than
+min_memory.
+
+The peak memory used by the jobs is recorded in the state database.
+It is used to compute the number of jobs in auto mode: the available
+memory divided by the memory of the most expensive class of jobs
+(the jobs producing files with the same extension) if this number
+is lower than the number of processors."""
+
+import os
+
+from maat import db
+
+max_load = None
+"""Maximum load average to start a new job or None."""
+min_memory = None
+"""Minimum available memory (in bytes) to start a new job or None."""
+
+
+def load_average():
+	"""Get the load average of the last minute or None."""
+	try:
+		return os.getloadavg()[0]
+	except OSError:
+		return None
+
+
+def free_memory():
+	"""Get the available memory (in bytes) or None."""
+	try:
+		with open("/proc/meminfo") as f:
+			for l in f:
+				if l.startswith("MemAvailable:"):
+					return int(l.split()[1]) * 1024
+	except (IOError, OSError, ValueError, IndexError):
+		pass
+	return None
+
+
+def overloaded():
+	"""Test if the machine is too loaded to start a new job."""
+	if max_load != None:
+		l = load_average()
+		if l != None and l >= max_load:
+			return True
+	if min_memory != None:
+		m = free_memory()
+		if m != None and m < min_memory:
+			return True
+	return False
+
+
+def job_class(target):
+	"""Get the class of the job building the given target path."""
+	return os.path.splitext(target)[1]
+
+
+def auto_jobs():
+	"""Compute the number of jobs from the number of processors and
+	from the memory used by the jobs at the previous builds."""
+	jobs = os.cpu_count()
+	classes = { }
+	for target, memory in db.query_all("SELECT target, memory FROM memory"):
+		classes.setdefault(job_class(target), []).append(memory)
+	free = free_memory()
+	if not classes or free == None:
+		return jobs
+	memory = max([sum(ms) / len(ms) for ms in classes.values()])
+	return max(1, min(jobs, int(free // memory)))
@@ -0,0 +1,168 @@
+#	MAAT watch module
+#	Copyright (C) 2016 H. Casse <hugues.casse@laposte.net>
+#
+#	This program is free software: you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation, either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	This program is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""This module implements the watch mode: after a first build, the
+source files the goals depend on are watched and, when some of them
+change, the goals are built again. As the build graph stays in memory,
+only the changed files have to be examined again.
+
+The files are watched with inotify on Linux and by polling their status
+on other systems. The changes are collected until no change happens
+for DEBOUNCE seconds (an editor or a VCS usually changes several files
+at once). If a script changes, the process executes again itself."""
+
+import ctypes
+import os
+import select
+import struct
+import time
+
+from maat import common
+from maat import graph
+from maat import recipe
+from maat import server
+
+PERIOD = .5
+"""Period (in seconds) of file status polling."""
+DEBOUNCE = .2
+"""Time (in seconds) without change ending a sequence of changes."""
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+"""Events watched with inotify."""
+EVENT = struct.Struct("iIII")
+"""Header of an inotify event (wd, mask, cookie, len)."""
+
+
+def leaves(goals):
+	"""Get the paths of the source files (files without recipe) the
+	given goals depend on."""
+	paths = []
+	todo = list(goals)
+	visited = set()
+	while todo:
+		f = todo.pop()
+		if f in visited:
+			continue
+		visited.add(f)
+		if f.recipe == None:
+			if not f.is_phony:
+				paths.append(str(f.actual()))
+		else:
+			todo = todo + f.recipe.deps + graph.logged(f)
+	return paths
+
+
+def stamp(path):
+	"""Get the modification time and the size of the given path
+	(None if it doesn't exist)."""
+	s = common.stat_file(path)
+	if s == None:
+		return None
+	else:
+		return (s.st_mtime_ns, s.st_size)
+
+
+class Watcher:
+	"""Watcher polling the status of the files."""
+
+	def wait(self, paths):
+		"""Wait for changes of the given paths and return the list
+		of changed paths."""
+		stamps = dict([(p, stamp(p)) for p in paths])
+		changed = []
+		while True:
+			time.sleep(DEBOUNCE if changed else PERIOD)
+			news = [p for p in paths if stamp(p) != stamps[p]]
+			if changed and not news:
+				return changed
+			for p in news:
+				stamps[p] = stamp(p)
+				if p not in changed:
+					changed.append(p)
+
+
+class InotifyWatcher(Watcher):
+	"""Watcher using the inotify system calls of Linux. As editors
+	often replace the files, the directories containing the files are
+	watched."""
+
+	def __init__(self):
+		self.libc = ctypes.CDLL(None, use_errno = True)
+		self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), "inotify_init1")
+		self.dirs = { }
+
+	def add(self, dir):
+		"""Watch the given directory (if not already done)."""
+		wd = self.libc.inotify_add_watch(self.fd, dir.encode(), IN_MASK)
+		if wd >= 0:
+			self.dirs[wd] = dir
+
+	def wait(self, paths):
+		watched = set()
+		for p in paths:
+			watched.add(p)
+			dir = os.path.dirname(p)
+			if dir not in self.dirs.values():
+				self.add(dir)
+		changed = []
+		while True:
+			r, w, x = select.select([self.fd], [], [], DEBOUNCE if changed else None)
+			if not r:
+				return changed
+			data = os.read(self.fd, 65536)
+			i = 0
+			while i < len(data):
+				wd, mask, cookie, size = EVENT.unpack_from(data, i)
+				name = data[i + EVENT.size:i + EVENT.size + size].rstrip(b"\0").decode()
+				i = i + EVENT.size + size
+				if wd in self.dirs:
+					p = os.path.join(self.dirs[wd], name)
+					if p in watched and p not in changed:
+						changed.append(p)
+
+
+def make_watcher():
+	"""Build the best watcher for the current system."""
+	try:
+		return InotifyWatcher()
+	except (OSError, AttributeError):
+		return Watcher()
+
+
+def run(ctx, defs, goals, build):
+	"""Build the goals and build them again each time the files they
+	depend on change. build is the function performing the build."""
+	watcher = make_watcher()
+	build()
+	scripts = graph.scripts + [graph.config_path()]
+	while True:
+		paths = leaves(goals)
+		ctx.print_info("watching %d files (type ^C to stop)" % len(paths))
+		changed = watcher.wait(paths + scripts)
+		if [p for p in changed if p in scripts]:
+			server.reload(defs)
+		for p in changed:
+			common.invalidate(p)
+		recipe.reset_updates()
+		build()